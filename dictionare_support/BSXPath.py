@@ -16,6 +16,7 @@ Usage:
   #*** PREPARATION (create object)
   document = BSXPathEvaluator(<html>) # BSXPathEvaluator is sub-class of BeautifulSoup
     # html: HTML (text string)
+    #   pass unicode (or bytes with fromEncoding=<encoding>) to skip encoding detection
   
   #*** BASIC OPERATIONS
   result = document.evaluate(<expression>,<node>,None,<type>,None)
@@ -27,12 +28,23 @@ Usage:
     # (*) 3rd(resolver) and 5th(result) arguments are not implemented
   length = result.snapshotLength
   node   = result.snapshotItem(<number>)
+  node   = result.iterateNext() # *_ITERATOR_TYPE: evaluated as the nodes are asked for (IndexError at the end)
   
   #*** USEFUL WRAPPER-FUNCTIONS
   nodes = document.getItemList(<expression>[,<node>])
   first = document.getFirstItem(<expression>[,<node>])
-    # expression: XPath expression
+    # expression: XPath expression (or XPathQuery)
     # node(optional): base context-node(default: document(document-root))
+  
+  #*** COMPILE ONCE, EVALUATE MANY
+  query = XPathQuery(<expression>) # document-independent
+  nodes = query.all(document[,<node>])
+  first = query.first(document[,<node>])
+  
+  #*** EXPRESSION CACHE
+  # createExpression() reuses compiled expressions from ExpressionCache
+  # (USE_EXPR_CACHE, EXPR_CACHE_SIZE); see ExpressionCache.hits/misses
+  ExpressionCache.resize(<number>)
 
 
 Examples:
@@ -70,7 +82,8 @@ Notice:
      - BeautifulSoup 3.0.7+(recommended) or 3.1.0+
 
 """
-import re,types,math,datetime
+import re,types,math,datetime,threading,itertools,heapq,operator,bisect
+from collections import OrderedDict
 #import logging
 from BeautifulSoup import *
 
@@ -84,6 +97,9 @@ except:
 #***** Optional Parameters
 USE_NODE_CACHE=True
 USE_NODE_INDEX=True
+INDEXED_ATTRIBUTES=frozenset(['id','class','name']) # [@name="value"] lookups go through an index for these
+USE_EXPR_CACHE=True
+EXPR_CACHE_SIZE=256
 
 
 #***** General Functions
@@ -311,20 +327,29 @@ def makeNodeUtils():
       else:
         return None
     
+    # with USE_NODE_INDEX, these compare the preorder intervals set up by
+    # BSXPathEvaluator._init_index (attributes take their owner's interval);
+    # preceding/following tell whether cnode is an earlier/later sibling element
     def _contains(node,cnode):
+      if USE_NODE_INDEX:
+        return node._sortindex<cnode._sortindex<=node._sortlast
       if _nodeType(node)==NodeTypeDOM.ATTRIBUTE_NODE: node=node.parentNode
       if _nodeType(cnode)==NodeTypeDOM.ATTRIBUTE_NODE: cnode=cnode.parentNode
       return node in cnode.findParents()
     
     def _preceding(node,cnode):
-      if _nodeType(node)==NodeTypeDOM.ATTRIBUTE_NODE: node=node.parentNode
-      if _nodeType(cnode)==NodeTypeDOM.ATTRIBUTE_NODE: cnode=cnode.parentNode
+      if isinstance(node,AttributeWrapper): node=node.parentNode
+      if isinstance(cnode,AttributeWrapper): cnode=cnode.parentNode
+      if USE_NODE_INDEX:
+        return isinstance(cnode,Tag) and cnode.parent is node.parent and cnode._sortindex<node._sortindex
       #return cnode in node.findAllPrevious()
       return cnode in node.findPreviousSiblings()
     
     def _following(node,cnode):
-      if _nodeType(node)==NodeTypeDOM.ATTRIBUTE_NODE: node=node.parentNode
-      if _nodeType(cnode)==NodeTypeDOM.ATTRIBUTE_NODE: cnode=cnode.parentNode
+      if isinstance(node,AttributeWrapper): node=node.parentNode
+      if isinstance(cnode,AttributeWrapper): cnode=cnode.parentNode
+      if USE_NODE_INDEX:
+        return isinstance(cnode,Tag) and cnode.parent is node.parent and node._sortindex<cnode._sortindex
       #return cnode in node.findAllNext()
       return cnode in node.findNextSiblings()
     
@@ -490,11 +515,84 @@ def makeNodeUtils():
     #} // _extTag
     
     def _it_deepNodes(node):
+      if USE_NODE_INDEX and not isinstance(node,AttributeWrapper):
+        preorder=getattr(_ownerDocument(node),'_preorder',None)
+        if preorder is not None:
+          return itertools.islice(preorder,node._sortindex,node._sortlast)
+      return _walkDeepNodes(node)
+    
+    def _indexedDocument(node):
+      # the node's document if it carries the indexes built by
+      # BSXPathEvaluator._init_index, else None
+      if not USE_NODE_INDEX:
+        return None
+      doc=_ownerDocument(node)
+      if getattr(doc,'_tagindex',None) is None:
+        return None
+      return doc
+    
+    def _descendantsAt(doc,node,positions):
+      # iterate over the nodes at those of the (sorted) positions that lie
+      # below node
+      if not positions or isinstance(node,AttributeWrapper):
+        return []
+      preorder=doc._preorder
+      start=bisect.bisect_right(positions,node._sortindex)
+      end=bisect.bisect_right(positions,node._sortlast,start)
+      return (preorder[positions[i]-1] for i in xrange(start,end))
+    
+    def _getElementsByTagName(node,name):
+      # descendant elements named name (any if '*'), looked up in the tag index
+      # of the node's document; None if the document isn't indexed
+      doc=_indexedDocument(node)
+      if doc is None:
+        return None
+      return _descendantsAt(doc,node,doc._tagindex.get(name or '*'))
+    
+    def _getElementsByAttribute(node,attrName,attrValue):
+      # descendant elements whose attrName is attrValue, from the document's
+      # attribute index; None if attrName isn't in INDEXED_ATTRIBUTES or the
+      # document isn't indexed
+      if attrName not in INDEXED_ATTRIBUTES:
+        return None
+      doc=_indexedDocument(node)
+      if doc is None:
+        return None
+      return _descendantsAt(doc,node,_attributeIndex(doc,attrName).get(attrValue))
+    
+    def _getElementsById(node,ids):
+      # elements of the node's document with any of the ids, in document
+      # order; None if the document isn't indexed
+      doc=_indexedDocument(node)
+      if doc is None:
+        return None
+      values=_attributeIndex(doc,'id')
+      positions=set()
+      for id in ids:
+        positions.update(values.get(id,()))
+      preorder=doc._preorder
+      return [preorder[idx-1] for idx in sorted(positions)]
+    
+    def _attributeIndex(doc,attrName):
+      # value -> _sortindex list for attrName, built on first use
+      attrIndex=doc._attrindex
+      values=attrIndex.get(attrName)
+      if values is None:
+        values={}
+        preorder=doc._preorder
+        for idx in doc._tagindex['*']:
+          value=preorder[idx-1].get(attrName)
+          if value is not None:
+            values.setdefault(value,[]).append(idx)
+        attrIndex[attrName]=values
+      return values
+    
+    def _walkDeepNodes(node):
       child_next=iter(getattr(node,'contents',[])).next
       while True:
         child=child_next()
         yield child
-        for gchild in _it_deepNodes(child):
+        for gchild in _walkDeepNodes(child):
           yield gchild
     
     return ExtDict({
@@ -509,6 +607,9 @@ def makeNodeUtils():
     , 'preceding'    :_preceding
     , 'following'    :_following
     , 'it_deepNodes' :_it_deepNodes
+    , 'getElementsByTagName':_getElementsByTagName
+    , 'getElementsByAttribute':_getElementsByAttribute
+    , 'getElementsById':_getElementsById
     })
     return
     
@@ -546,6 +647,22 @@ def makeNodeUtils():
       if prevNodeset:
         prevNodeset.delDescendant(node,prevIndex)
       
+      if attrValue and attrName:
+        nodes=NodeUtilBS.getElementsByAttribute(node,attrName,attrValue)
+        if nodes is not None:
+          for elm in nodes:
+            if test.match(elm):
+              nodeset.push(elm)
+          return nodeset
+      
+      elif not getattr(test,'notOnlyElement',None):
+        nodes=NodeUtilBS.getElementsByTagName(node,getattr(test,'name',None))
+        if nodes is not None:
+          for elm in nodes:
+            if NodeUtil.attrMatch(elm,attrName,attrValue):
+              nodeset.push(elm)
+          return nodeset
+      
       if USE_NODE_CACHE:
         _cachemap=getattr(node,'_cachemap',None)
         if not _cachemap:
@@ -619,6 +736,21 @@ def makeNodeUtils():
       
       return nodeset
     
+    def _iterDescendantNodes(test,node,attrName,attrValue):
+      # getDescendantNodes as an iterator, lazy where the document's indexes
+      # (or a plain walk) can answer it
+      if attrValue and attrName:
+        nodes=NodeUtilBS.getElementsByAttribute(node,attrName,attrValue)
+        if nodes is not None:
+          return (elm for elm in nodes if test.match(elm))
+      elif getattr(test,'notOnlyElement',None):
+        return (elm for elm in NodeUtilBS.it_deepNodes(node) if NodeUtil.attrMatch(elm,attrName,attrValue) and test.match(elm))
+      else:
+        nodes=NodeUtilBS.getElementsByTagName(node,getattr(test,'name',None))
+        if nodes is not None:
+          return (elm for elm in nodes if NodeUtil.attrMatch(elm,attrName,attrValue))
+      return _getDescendantNodes(test,node,NodeSet(),attrName,attrValue,None,None).list()
+    
     def _getChildNodes(test,node,nodeset,attrName,attrValue,prevNodeset,prevIndex):
       contents=getattr(node,'contents',[])
       for elm in contents:
@@ -631,6 +763,7 @@ def makeNodeUtils():
       'to'                :_to
     , 'attrMatch'         :_attrMatch
     , 'getDescendantNodes':_getDescendantNodes
+    , 'iterDescendantNodes':_iterDescendantNodes
     , 'getChildNodes'     :_getChildNodes
     })
   
@@ -699,6 +832,15 @@ class AttributeWrapper(object):
   def get(self,key,default=None):
     return None
   
+  # attributes sort along with their owner element
+  @property
+  def _sortindex(self):
+    return self.parentNode._sortindex
+  
+  @property
+  def _sortlast(self):
+    return self.parentNode._sortlast
+  
   def contains(self,cnode):
     return NodeUtilBS.contains(self,cnode)
   
@@ -776,7 +918,7 @@ class BaseExprHasPredicates(BaseExpr):
     l0=len(predicates)
     for i in range(start,l0):
       predicate=predicates[i]
-      deleteIndexes=[]
+      survivors=[]
       nodes=nodeset.list()
       
       l1=len(nodes)
@@ -784,23 +926,40 @@ class BaseExprHasPredicates(BaseExpr):
         position=(l1-j) if reverse else (j+1)
         exrs=predicate.evaluate(Ctx(nodes[j],position,l1))
         
-        if typeof(exrs)=='number':
-          exrs=(position==exrs)
-        elif typeof(exrs)=='string':
-          exrs=False if exrs=='' else True
-        elif typeof(exrs)=='object':
-          exrs=exrs.bool()
-        
-        if not exrs:
-          deleteIndexes.append(j)
+        if self.predicateTrue(exrs,position):
+          survivors.append(nodes[j])
       
-      r=range(0,len(deleteIndexes))
-      r.sort(reverse=True)
-      for j in r:
-        nodeset._del(deleteIndexes[j])
+      if len(survivors)<l1:
+        nodeset.replaceNodes(survivors)
     
     return nodeset
   
+  def iteratePredicates(self,nodes,start=0):
+    # evaluatePredicates over an iterable of nodes in (forward) document
+    # order, filtering lazily; only for steps without needContextPosition,
+    # as last() is unknown until the end
+    for predicate in getattr(self,'predicates',[])[start:]:
+      nodes=self._iteratePredicate(predicate,nodes)
+    return nodes
+  
+  @classmethod
+  def _iteratePredicate(cls,predicate,nodes):
+    position=0
+    for node in nodes:
+      position+=1
+      if cls.predicateTrue(predicate.evaluate(Ctx(node,position,position)),position):
+        yield node
+  
+  @staticmethod
+  def predicateTrue(exrs,position):
+    if typeof(exrs)=='number':
+      return position==exrs
+    elif typeof(exrs)=='string':
+      return False if exrs=='' else True
+    elif typeof(exrs)=='object':
+      return exrs.bool()
+    return exrs
+  
   @classmethod
   def parsePredicates(cls,lexer,expr):
     while lexer.peek()=='[':
@@ -1066,6 +1225,34 @@ class UnionExpr(BaseExpr):
     
     return nodeset
   
+  def iterate(self,ctx):
+    # evaluate() as an iterator in document order (see PathExpr.iterate)
+    key=NodeSet.sortKey
+    getID=NodeSet.NodeID.get
+    def keyed(nodes,i):
+      for node in nodes:
+        yield (key(node),i,node)
+    
+    iterators=[]
+    for (i,path) in enumerate(self.paths):
+      if isinstance(path,PathExpr):
+        nodes=path.iterate(ctx)
+      else:
+        nodes=path.evaluate(ctx)
+        if not getattr(nodes,'isNodeSet',None):
+          throwError(u'PathExpr must be nodeset')
+        nodes=nodes.list()
+      iterators.append(keyed(nodes,i))
+    
+    (seenKey,seen)=(None,set())
+    for (k,i,node) in heapq.merge(*iterators):
+      if k!=seenKey:
+        (seenKey,seen)=(k,set())
+      id=getID(node)
+      if id not in seen:
+        seen.add(id)
+        yield node
+  
   def path(self,path):
     self.paths.append(path)
     
@@ -1126,42 +1313,75 @@ class PathExpr(BaseExpr):
     for _step in self.steps:
       if nodeset.length<=0:
         break
-      step=_step[1] # _step=[op,step]
-      reverse=step.reverse
-      iter=nodeset.iterator(reverse)
-      prevNodeset=nodeset
-      nodeset=None
-      needContextPosition=getattr(step,'needContextPosition',None)
-      axis=step.axis
-      if not needContextPosition and axis=='following':
-        node=iter()
-        while True:
-          next=iter()
-          if not next:
-            break
-          if not node.contains(next):
-            break
-          node=next
-        
-        nodeset=step.evaluate(Ctx(node))
-      
-      elif not needContextPosition and axis=='preceding':
-        node=iter()
-        nodeset=step.evaluate(Ctx(node))
+      nodeset=self.evaluateStep(nodeset,_step[1]) # _step=[op,step]
+    
+    return nodeset
+  
+  def evaluateStep(self,nodeset,step):
+    reverse=step.reverse
+    iter=nodeset.iterator(reverse)
+    prevNodeset=nodeset
+    nodeset=None
+    needContextPosition=getattr(step,'needContextPosition',None)
+    axis=step.axis
+    if not needContextPosition and axis=='following':
+      node=iter()
+      while True:
+        next=iter()
+        if not next:
+          break
+        if not node.contains(next):
+          break
+        node=next
       
-      else:
+      nodeset=step.evaluate(Ctx(node))
+    
+    elif not needContextPosition and axis=='preceding':
+      node=iter()
+      nodeset=step.evaluate(Ctx(node))
+    
+    else:
+      node=iter()
+      j=0
+      nodeset=step.evaluate(Ctx(node),False,prevNodeset,j)
+      nodesets=[]
+      while True:
         node=iter()
-        j=0
-        nodeset=step.evaluate(Ctx(node),False,prevNodeset,j)
-        while True:
-          node=iter()
-          if not node:
-            break
-          j+=1
-          nodeset.merge(step.evaluate(Ctx(node),False,prevNodeset,j))
+        if not node:
+          break
+        j+=1
+        nodesets.append(step.evaluate(Ctx(node),False,prevNodeset,j))
+      if nodesets:
+        nodeset.mergeAll(nodesets)
     
     return nodeset
   
+  def iterate(self,ctx):
+    # evaluate() as an iterator over the result in document order: steps on
+    # forward axes pull their context nodes from the previous step only as
+    # far as needed, so taking the first node skips most of the work
+    nodeset=self.filter.evaluate(ctx)
+    if not getattr(nodeset,'isNodeSet',None):
+      throwException('Filter nodeset must be nodeset type')
+    
+    nodes=nodeset.list()
+    for _step in self.steps:
+      step=_step[1] # _step=[op,step]
+      if step.axis in Step.lazyAxises:
+        nodes=step.iterate(nodes)
+        continue
+      
+      # other axes go backwards (or, for following, far ahead): collect the
+      # context nodes and evaluate the step as evaluate() does
+      nodeset=NodeSet()
+      for node in nodes:
+        nodeset.push(node)
+      if nodeset.length<=0:
+        return iter([])
+      nodes=self.evaluateStep(nodeset,step).list()
+    
+    return iter(nodes)
+  
   def step(self,op,step):
     step.op=op
     self.steps.append([op,step])
@@ -1324,6 +1544,7 @@ class Step(BaseExprHasPredicates):
     self.predicates=[]
     self._quickAttr=self.axises[axis][2]
     self.quickAttr=False
+    self.quickPosition=None
     self.needContextPosition=False
   
   def evaluate(self,ctx,special=False,prevNodeset=None,prevIndex=None):
@@ -1343,19 +1564,24 @@ class Step(BaseExprHasPredicates):
       else:
         step=Step('descendant-or-self',NodeType('node'))
         nodes=step.evaluate(ctx,False,prevNodeset,prevIndex).list()
-        nodeset=None
         step.op='/'
-        for _node in nodes:
-          if not nodeset:
-            nodeset=self.evaluate(Ctx(_node),True,None,None)
-          else:
-            nodeset.merge(self.evaluate(Ctx(_node),True,None,None))
-        nodeset=nodeset or NodeSet()
+        nodesets=[self.evaluate(Ctx(_node),True,None,None) for _node in nodes]
+        if nodesets:
+          nodeset=nodesets[0]
+          nodeset.mergeAll(nodesets[1:])
+        else:
+          nodeset=NodeSet()
     else:
       if getattr(self,'needContextPosition',None):
         prevNodeset=None
         prevIndex=None
-      if getattr(self,'quickAttr',None):
+      if self.quickPosition:
+        nodeset=NodeSet()
+        elm=self.positionalNode(node)
+        if elm is not None:
+          nodeset.push(elm)
+        nodeset=self.evaluatePredicates(nodeset,1)
+      elif getattr(self,'quickAttr',None):
         attrValueExpr=getattr(self,'attrValueExpr',None)
         attrValue=attrValueExpr.string(ctx) if attrValueExpr else None
         nodeset=self.func(self.test,node,NodeSet(),self.attrName,attrValue,prevNodeset,prevIndex)
@@ -1368,6 +1594,58 @@ class Step(BaseExprHasPredicates):
     
     return nodeset
   
+  def iterate(self,contexts):
+    # this step from each of contexts (in document order), as an iterator in
+    # document order; see PathExpr.iterate
+    # a context inside the previous one adds nothing to a '//' or (position-free) descendant step
+    skipContained=self.op=='//' or not self.needContextPosition and self.axis in ('descendant','descendant-or-self')
+    return NodeSet.iterMerge(contexts,self.iterateFrom,skipContained)
+  
+  def iterateFrom(self,node,special=False):
+    # evaluate() for one context node, lazily where there are no positional
+    # predicates
+    if not special and getattr(self,'op',None)=='//':
+      if not self.needContextPosition and self.axis=='child':
+        if getattr(self,'quickAttr',None):
+          attrValueExpr=getattr(self,'attrValueExpr',None)
+          attrValue=attrValueExpr.string(Ctx(node)) if attrValueExpr else None
+          return self.iteratePredicates(NodeUtil.iterDescendantNodes(self.test,node,self.attrName,attrValue),1)
+        return self.iteratePredicates(NodeUtil.iterDescendantNodes(self.test,node,None,None))
+      
+      nodes=itertools.chain([node],NodeUtilBS.it_deepNodes(node))
+      return NodeSet.iterMerge(nodes,lambda _node:self.iterateFrom(_node,True))
+    
+    if self.needContextPosition or self.axis not in self.lazyAxises:
+      return self.evaluate(Ctx(node),True).list()
+    
+    test=self.test
+    (attrName,attrValue)=(None,None)
+    if getattr(self,'quickAttr',None):
+      attrName=self.attrName
+      attrValueExpr=getattr(self,'attrValueExpr',None)
+      attrValue=attrValueExpr.string(Ctx(node)) if attrValueExpr else None
+    
+    axis=self.axis
+    if axis=='child':
+      nodes=(elm for elm in getattr(node,'contents',[]) if NodeUtil.attrMatch(elm,attrName,attrValue) and test.match(elm))
+    elif axis=='descendant':
+      nodes=NodeUtil.iterDescendantNodes(test,node,attrName,attrValue)
+    elif axis=='descendant-or-self':
+      nodes=NodeUtil.iterDescendantNodes(test,node,attrName,attrValue)
+      if NodeUtil.attrMatch(node,attrName,attrValue) and test.match(node):
+        nodes=itertools.chain([node],nodes)
+    elif axis=='following-sibling':
+      nodes=(elm for elm in self._siblings(node,'nextSibling') if test.match(elm))
+    else:
+      # self, attribute: a handful of nodes at most
+      nodes=self.func(test,node,NodeSet(),attrName,attrValue,None,None).list()
+    
+    return self.iteratePredicates(nodes,1 if attrName else 0)
+  
+  # axes whose nodes all come at or after the context node, which
+  # NodeSet.iterMerge relies on
+  lazyAxises=frozenset(['child','descendant','descendant-or-self','self','attribute','following-sibling'])
+  
   def predicate(self,predicate):
     self.predicates.append(predicate)
     datatype=getattr(predicate,'datatype',None)
@@ -1379,6 +1657,51 @@ class Step(BaseExprHasPredicates):
       self.attrName=attrName
       self.attrValueExpr=getattr(predicate,'attrValueExpr',None)
       self.quickAttr=True
+    
+    # [n] or [last()] first on a child/sibling axis: walk to that node instead of
+    # collecting every candidate (see positionalNode)
+    if len(self.predicates)==1 and self.axis in ('child','following-sibling','preceding-sibling'):
+      if isinstance(predicate,Number) and 1<=predicate.digit and predicate.digit==int(predicate.digit):
+        self.quickPosition=int(predicate.digit)
+      elif isinstance(predicate,FunctionCall) and predicate.name=='last' and not predicate.args:
+        self.quickPosition=-1
+  
+  def positionalNode(self,node):
+    test=self.test
+    axis=self.axis
+    position=self.quickPosition
+    if position<0:
+      # last(): the first match counting from the far end of the axis
+      position=1
+      if axis=='child':
+        candidates=reversed(getattr(node,'contents',[]))
+      else:
+        parent=node.parent
+        siblings=parent.contents if parent else []
+        if axis=='following-sibling':
+          siblings=reversed(siblings)
+        candidates=itertools.takewhile(lambda elm:elm is not node,siblings)
+    elif axis=='child':
+      candidates=getattr(node,'contents',[])
+    elif axis=='following-sibling':
+      candidates=self._siblings(node,'nextSibling')
+    else:
+      candidates=self._siblings(node,'previousSibling')
+    
+    for elm in candidates:
+      if test.match(elm):
+        position-=1
+        if position<=0:
+          return elm
+    return None
+  
+  @staticmethod
+  def _siblings(node,direction):
+    while True:
+      node=getattr(node,direction)
+      if not node:
+        break
+      yield node
   
   def show(self,indent=''):
     t=''
@@ -1841,6 +2164,12 @@ class FunctionCall(BaseExpr):
     s=s.string(self)
     ids=re_seqspace.split(s)
     nodeset=NodeSet()
+    nodes=NodeUtilBS.getElementsById(doc,ids)
+    if nodes is not None:
+      for elm in nodes:
+        nodeset.push(elm)
+      return nodeset
+    
     for id in ids:
       for elm in doc.findAll(id=id):
         nodeset.push(elm)
@@ -2154,7 +2483,7 @@ class NodeSet(object):
   def __init__(self):
     self.length=0
     self.nodes=[]
-    self.seen={}
+    self._seen={}
     self.idIndexMap=None
     self.reserveDels=[]
     self.isNodeSet=True
@@ -2162,18 +2491,128 @@ class NodeSet(object):
     self.sortOff=False
     self.only=None
   
+  @property
+  def seen(self):
+    # dropped by replaceNodes, and only rebuilt if something is added or deleted later
+    if self._seen is None:
+      getID=self.NodeID.get
+      self._seen=dict((getID(node),True) for node in self.nodes)
+    return self._seen
+  
+  def replaceNodes(self,nodes):
+    # swap in a subset of the current (sorted) nodes in one go
+    self.only=None
+    self.nodes=nodes
+    self.length=len(nodes)
+    self._seen=None
+    self.idIndexMap=None
+  
   def merge(self,nodeset):
-    self.isSorted=False
-    if getattr(nodeset,'only',None):
-      return self.push(nodeset.only)
+    self.mergeAll([nodeset])
+  
+  def mergeAll(self,nodesets):
+    if USE_NODE_INDEX and getattr(self,'isSorted',None) and all(getattr(nodeset,'isSorted',None) for nodeset in nodesets):
+      return self._mergeSorted(nodesets)
     
+    self.isSorted=False
+    for nodeset in nodesets:
+      if getattr(nodeset,'only',None):
+        self.push(nodeset.only)
+        continue
+      
+      if getattr(self,'only',None):
+        only=self.only
+        self.only=None
+        self.push(only)
+        self.length-=1
+      
+      map(self._add,nodeset.nodes)
+  
+  def _mergeSorted(self,nodesets):
+    # every run is in document order already: drop duplicates, then either
+    # chain the runs (when they follow one another, as results of child or
+    # descendant steps from non-overlapping contexts do) or k-way merge them
+    # on _sortindex, so the result stays sorted
     if getattr(self,'only',None):
       only=self.only
       self.only=None
       self.push(only)
       self.length-=1
     
-    map(self._add,nodeset.nodes)
+    seen=self.seen
+    getID=self.NodeID.get
+    runs=[self.nodes] if self.nodes else []
+    for nodeset in nodesets:
+      run=[]
+      for node in nodeset.list():
+        id=getID(node)
+        if seen.get(id):
+          continue
+        seen[id]=True
+        run.append(node)
+      if run:
+        self.length+=len(run)
+        runs.append(run)
+    
+    key=self.sortKey
+    chained=True
+    for i in range(1,len(runs)):
+      if key(runs[i][0])<key(runs[i-1][-1]):
+        chained=False
+        break
+    
+    nodes=self.nodes
+    if chained:
+      for run in runs:
+        if run is not nodes:
+          nodes.extend(run)
+    else:
+      decorated=[[(key(node),i,j,node) for (j,node) in enumerate(run)] for (i,run) in enumerate(runs)]
+      self.nodes=[entry[3] for entry in heapq.merge(*decorated)]
+    self.idIndexMap=None
+  
+  # document-order key (the preorder index set up by BSXPathEvaluator._init_index)
+  sortKey=operator.attrgetter('_sortindex')
+  
+  @staticmethod
+  def iterMerge(contexts,evaluate,skipContained=False):
+    # lazy counterpart of merging evaluate(context) for each of contexts:
+    # contexts come in document order, and each evaluate() gives nodes in
+    # document order, none before its context. A node is yielded once no
+    # context still to come could produce anything earlier, so only the
+    # contexts needed so far are evaluated. With skipContained, a context
+    # inside the last evaluated one is skipped.
+    key=NodeSet.sortKey
+    getID=NodeSet.NodeID.get
+    contexts=iter(contexts)
+    context=next(contexts,None)
+    last=None
+    heap=[]
+    count=itertools.count()
+    (seenKey,seen)=(None,set())
+    while True:
+      while context is not None and (not heap or key(context)<=heap[0][0]):
+        if not (skipContained and last is not None and last.contains(context)):
+          last=context
+          nodes=iter(evaluate(context))
+          node=next(nodes,None)
+          if node is not None:
+            heapq.heappush(heap,(key(node),next(count),node,nodes))
+        context=next(contexts,None)
+      if not heap:
+        return
+      
+      (k,_,node,nodes)=heapq.heappop(heap)
+      # nodes come out in key order, so duplicates share a key
+      if k!=seenKey:
+        (seenKey,seen)=(k,set())
+      id=getID(node)
+      if id not in seen:
+        seen.add(id)
+        yield node
+      node=next(nodes,None)
+      if node is not None:
+        heapq.heappush(heap,(key(node),next(count),node,nodes))
   
   def sort(self):
     if getattr(self,'only',None):
@@ -2187,6 +2626,11 @@ class NodeSet(object):
     self.idIndexMap=None
     nodes=self.nodes
     
+    if USE_NODE_INDEX:
+      nodes.sort(key=self.sortKey)
+      return
+    
+    # no index: compare positions by walking up the ancestor chains
     def _comp(a,b):
       if a.nodeType==NodeTypeDOM.ATTRIBUTE_NODE: a=a.parentNode
       if b.nodeType==NodeTypeDOM.ATTRIBUTE_NODE: b=b.parentNode
@@ -2238,15 +2682,7 @@ class NodeSet(object):
       
       return 1
     
-    def index_comp(a,b):
-      if a.nodeType==NodeTypeDOM.ATTRIBUTE_NODE: a=a.parentNode
-      if b.nodeType==NodeTypeDOM.ATTRIBUTE_NODE: b=b.parentNode
-      return cmp(a._sortindex,b._sortindex)
-    
-    if USE_NODE_INDEX:
-      nodes.sort(index_comp)
-    else:
-      nodes.sort(_comp)
+    nodes.sort(_comp)
   
   def reserveDelByNodeID(self,id,offset,reverse):
     _map=self.createIdIndexMap()
@@ -2261,7 +2697,7 @@ class NodeSet(object):
   def doDel(self):
     if len(self.reserveDels)<=0:
       return
-    map(self._del,sorted(self.reserveDels,lambda x,y:cmp(y,x)))
+    map(self._del,sorted(self.reserveDels,reverse=True))
     self.reserveDels=[]
     self.idIndexMap=None
   
@@ -2387,14 +2823,13 @@ class NodeSet(object):
 
   class nodeID(object):
     def __init__(self):
-      self.uuid=1
+      self.uuid=itertools.count(1) # next() is atomic, so ids stay unique across threads
     
     def get(self,node):
       id=getattr(node,'__bsxpath_id__',None)
       if id:
         return id
-      id=node.__bsxpath_id__=self.uuid
-      self.uuid+=1
+      id=node.__bsxpath_id__=self.uuid.next()
       return id
   
   NodeID=nodeID()
@@ -2435,14 +2870,36 @@ class XPathResult(object):
       self.booleanValue=value.bool() if getattr(value,'isNodeSet',None) else toBoolean(value)
     elif type==self.ANY_UNORDERED_NODE_TYPE or type==self.FIRST_ORDERED_NODE_TYPE:
       self.singleNodeValue=value.first()
+    elif getattr(value,'next',None):
+      # iterator types from XPathExpression.evaluate: nodes are evaluated
+      # as iterateNext() asks for them, and not kept
+      self.source=value
+      self.index=0
+      self.invalidIteratorState=False
     else:
       self.nodes=value.list()
       self.snapshotLength=value.length
       self.index=0
       self.invalidIteratorState=False
   
+  def __getattr__(self,name):
+    # snapshotLength/snapshotItem() on a streamed result: collect the rest
+    # of it (nodes already returned by iterateNext() are gone)
+    if name in ('nodes','snapshotLength') and 'source' in self.__dict__:
+      self.nodes=[None]*self.index+list(self.source)
+      self.snapshotLength=len(self.nodes)
+      del self.source
+      return getattr(self,name)
+    raise AttributeError(name)
+  
   def iterateNext(self):
-    node=self.nodes[self.index]
+    source=self.__dict__.get('source')
+    if source is not None:
+      node=next(source,None)
+      if node is None:
+        raise IndexError(u'no more nodes')
+    else:
+      node=self.nodes[self.index]
     self.index+=1
     return node
   
@@ -2461,9 +2918,111 @@ class XPathExpression(object):
     self.expr=BinaryExpr.parse(lexer)
     if not lexer.empty():
       throwError(u'bad token: %s' % (lexer.next()))
+    self.lazy=isinstance(self.expr,(PathExpr,UnionExpr))
   
   def evaluate(self,node,type):
+    if USE_NODE_INDEX and self.lazy:
+      if type==XPathResult.FIRST_ORDERED_NODE_TYPE or type==XPathResult.ANY_UNORDERED_NODE_TYPE:
+        nodeset=NodeSet()
+        first=self.first(node)
+        if first is not None:
+          nodeset.push(first)
+        return XPathResult(nodeset,type)
+      if type==XPathResult.ORDERED_NODE_ITERATOR_TYPE or type==XPathResult.UNORDERED_NODE_ITERATOR_TYPE:
+        return XPathResult(self.expr.iterate(Ctx(node)),type)
     return XPathResult(self.expr.evaluate(Ctx(node)),type)
+  
+  def nodeset(self,node):
+    nodeset=self.expr.evaluate(Ctx(node))
+    if not getattr(nodeset,'isNodeSet',None):
+      throwError(u'expression result must be nodeset type')
+    return nodeset
+  
+  def first(self,node):
+    if USE_NODE_INDEX and self.lazy:
+      # stop at the first node in document order
+      return next(self.expr.iterate(Ctx(node)),None)
+    return self.nodeset(node).first()
+  
+  def all(self,node):
+    return self.nodeset(node).list()
+
+
+# Document-independent compiled query: parse once (e.g. at module import),
+# then evaluate against any BSXPathEvaluator document and context node, or
+# any other document with the same getItemList/getFirstItem surface.
+class XPathQuery(object):
+  def __init__(self,expr):
+    self.source=expr
+    self.expression=XPathExpression(expr,None)
+  
+  @staticmethod
+  def contextNode(document,context):
+    if context is None:
+      return document
+    if isinstance(context,list):
+      return context[0]
+    return context
+  
+  def first(self,document,context=None):
+    if not isinstance(document,BSXPathEvaluator):
+      # other evaluators (e.g. lxmlxpath) compile the source themselves
+      return document.getFirstItem(self,context)
+    return self.expression.first(XPathQuery.contextNode(document,context))
+  
+  def all(self,document,context=None):
+    if not isinstance(document,BSXPathEvaluator):
+      return document.getItemList(self,context)
+    return self.expression.all(XPathQuery.contextNode(document,context))
+  
+  def __repr__(self):
+    return 'XPathQuery(%r)' % (self.source)
+
+
+# LRU cache of compiled expressions keyed by expression string. Compiled
+# expressions hold no document state, so one cache serves every document.
+class XPathExpressionCache(object):
+  def __init__(self,maxsize=EXPR_CACHE_SIZE):
+    self.maxsize=maxsize
+    self.hits=0
+    self.misses=0
+    self._entries=OrderedDict()
+    self._lock=threading.Lock()
+  
+  def get(self,expr,resolver=None):
+    lock=self._lock
+    entries=self._entries
+    with lock:
+      expression=entries.pop(expr,None)
+      if expression is not None:
+        entries[expr]=expression
+        self.hits+=1
+        return expression
+      self.misses+=1
+    
+    expression=XPathExpression(expr,resolver)
+    with lock:
+      entries[expr]=expression
+      while self.maxsize<len(entries):
+        entries.popitem(last=False)
+    return expression
+  
+  def resize(self,maxsize):
+    with self._lock:
+      self.maxsize=maxsize
+      while maxsize<len(self._entries):
+        self._entries.popitem(last=False)
+  
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.hits=0
+      self.misses=0
+  
+  def __len__(self):
+    return len(self._entries)
+
+ExpressionCache=XPathExpressionCache()
 
 
 class BSXPathEvaluator(BeautifulSoup):
@@ -2478,13 +3037,55 @@ class BSXPathEvaluator(BeautifulSoup):
   # exclude 'link' for XML
   
   def _init_index(self):
-    idx=self._sortindex=1
     self._cachemap=None
     
-    for node in NodeUtilBS.it_deepNodes(self):
+    # flat preorder array of the whole document: the node with _sortindex i
+    # sits at _preorder[i-1], and its descendants are _preorder[i:_sortlast]
+    preorder=self._preorder=[]
+    stack=[self]
+    while stack:
+      node=stack.pop()
+      preorder.append(node)
+      if isinstance(node,Tag):
+        stack.extend(reversed(node.contents))
+    
+    # tag name ('*' for any) -> the _sortindex of each element so named
+    tagIndex=self._tagindex={'*':[]}
+    # attribute name -> value -> _sortindex list, filled in on first use
+    # (for id() and the INDEXED_ATTRIBUTES)
+    self._attrindex={}
+    
+    idx=0
+    for node in preorder:
       idx=node._sortindex=idx+1
-    for node in self.findAll():
-      node.attrMap=dict(node.attrs)
+      node._owner=self
+      if isinstance(node,Tag) and node is not self:
+        tagIndex['*'].append(idx)
+        tagIndex.setdefault(node.name,[]).append(idx)
+    # _sortlast: the last index within the node's subtree, so a node contains
+    # exactly the nodes indexed in (_sortindex,_sortlast]
+    for node in reversed(preorder):
+      contents=node.contents if isinstance(node,Tag) else None
+      node._sortlast=contents[-1]._sortlast if contents else node._sortindex
+    for node in preorder[1:]:
+      if isinstance(node,Tag):
+        node.attrMap=dict(node.attrs)
+    
+    if USE_NODE_INDEX:
+      # the DOM properties read in the inner loops, as plain attributes
+      # instead of through the __getattr__ hooks of makeNU_BS (which still
+      # answer for nodeValue/attributes, and for trees modified afterwards)
+      (self.nodeType,self.nodeName)=(NodeTypeDOM.DOCUMENT_NODE,'#document')
+      (self.parentNode,self.ownerDocument)=(None,None)
+      for node in preorder[1:]:
+        cls=node.__class__
+        if cls is Tag:
+          (node.nodeType,node.nodeName)=(NodeTypeDOM.ELEMENT_NODE,node.name.lower())
+        elif cls is NavigableString:
+          (node.nodeType,node.nodeName)=(NodeTypeDOM.TEXT_NODE,'#text')
+        else:
+          (node.nodeType,node.nodeName)=(node.nodeType,node.nodeName)
+        (node.parentNode,node.ownerDocument)=(node.parent,self)
   
   def _fix_table(self):
     tables=self.findAll('table')
@@ -2527,6 +3128,8 @@ class BSXPathEvaluator(BeautifulSoup):
     return self._string
   
   def createExpression(self,expr,resolver):
+    if USE_EXPR_CACHE and 0<ExpressionCache.maxsize:
+      return ExpressionCache.get(expr,resolver)
     return XPathExpression(expr,resolver)
   
   def createNSResolver(self,nodeResolver):
@@ -2541,15 +3144,14 @@ class BSXPathEvaluator(BeautifulSoup):
     return self.createExpression(expr,resolver).evaluate(context,type)
   
   def getItemList(self,expr,context=None):
-    elms=[]
-    result=self.evaluate(expr,context,None,XPathResult.ORDERED_NODE_SNAPSHOT_TYPE,None)
-    for i in range(0,result.snapshotLength):
-      elms.append(result.snapshotItem(i))
-    return elms
+    if isinstance(expr,XPathQuery):
+      return expr.all(self,context)
+    return self.createExpression(expr,None).all(XPathQuery.contextNode(self,context))
   
   def getFirstItem(self,expr,context=None):
-    elm=self.evaluate(expr,context,None,XPathResult.FIRST_ORDERED_NODE_TYPE,None).singleNodeValue
-    return elm
+    if isinstance(expr,XPathQuery):
+      return expr.first(self,context)
+    return self.createExpression(expr,None).first(XPathQuery.contextNode(self,context))
   
   def applyXPath(self,context,expr):
     start_t=datetime.datetime.now()
@@ -2591,10 +3193,10 @@ if __name__ == '__main__':
   def prn(obj):
     def prn_sub(obj,indent):
       indent+=u'  '
-      if isinstance(obj,list):
-        for i in range(0,len(obj)):
+      if isinstance(obj,(list,types.GeneratorType)):
+        for (i,item) in enumerate(obj):
           print u'[%d]' % (i)
-          prn_sub(obj[i],indent)
+          prn_sub(item,indent)
       elif isinstance(obj,dict):
         for mem in obj:
           print u'[%s]' % (mem)
@@ -2619,9 +3221,20 @@ if __name__ == '__main__':
       else:
         document=BSXPathEvaluator(sys.stdin.read())
       
-      (result,time,resultType)=document.applyXPath(document,options.expr)
-      
-      prn(result)
+      expression=document.createExpression(options.expr,None)
+      if USE_NODE_INDEX and expression.lazy:
+        # print the nodes as they are found
+        result=expression.evaluate(document,XPathResult.ORDERED_NODE_ITERATOR_TYPE)
+        def nodes():
+          while True:
+            try:
+              yield result.iterateNext()
+            except IndexError:
+              return
+        prn(nodes())
+      else:
+        (result,time,resultType)=document.applyXPath(document,options.expr)
+        prn(result)
       
     else:
       optparser.print_help()
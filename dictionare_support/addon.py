@@ -1,62 +1,155 @@
 # -*- coding: utf-8 -*-
 
+import sip
+
 from anki.hooks import addHook
 from aqt import mw
 from aqt.utils import askUserDialog, showInfo
-from PyQt4.QtGui import QPushButton
+from PyQt4.QtCore import Qt, QThread, SIGNAL
+from PyQt4.QtGui import QAction, QProgressDialog, QPushButton
+
+from bulk import imap_unordered
+from lookup import lookup_word, normalize_headword
+
+
+# Number of lookups the browser's batch fill keeps in flight at once.
+BATCH_CONCURRENCY = 8
+
+
+class LookupThread(QThread):
+    """
+    Runs `lookup_word` off the GUI thread. Emits "lookupDone" with the
+    results and the exception raised, if any; Qt delivers it to receivers
+    on the main thread.
+    """
+
+    def __init__(self, word, part_of_speech):
+        QThread.__init__(self)
+        self.args = (word, part_of_speech)
+
+        # A bound method, which PyQt only holds weakly. A slot closing over
+        # the thread would keep it, and every slot connected to it, alive
+        # for good.
+        self.connect(self, SIGNAL("finished()"), self.forget)
+
+    def run(self):
+        try:
+            infos = lookup_word(*self.args)
+        except Exception as e:
+            self.emit(SIGNAL("lookupDone"), None, e)
+        else:
+            self.emit(SIGNAL("lookupDone"), infos, None)
+
+    def forget(self):
+        """
+        Drop the finished thread from `lookup_threads`, so that it is
+        deleted along with its connections. Runs on the main thread.
+        """
+
+        # finished() is emitted just before the thread stops running.
+        self.wait()
+        lookup_threads.discard(self)
+
+
+# Running lookup threads; Qt crashes if one is collected while it runs.
+# Each drops out once it has finished (see `LookupThread.forget`).
+lookup_threads = set()
 
 
-def download_and_insert_info(self, note_search_key, download_function,
-                           preliminary_extraction_function,
-                           final_extraction_function):
+def download_and_insert_info(self, button_name, part_of_speech):
     self.saveNow()
 
-    word = self.note[note_search_key]
-    word_stripped = strip_accents(word)
+    note_search_key = PARTS_OF_SPEECH[part_of_speech]
+    note = self.note
+    word = note[note_search_key]
+
+    # Show that the lookup is in progress (and block repeat clicks) until
+    # the thread reports back.
+    button = self._buttons.get(button_name)
+    if button is not None:
+        button_text = button.text()
+        button.setText(u"\u2026")
+        button.setEnabled(False)
+
+    thread = LookupThread(word, part_of_speech)
+
+    def on_done(infos, error):
+        # The Add/Edit window may have been closed during the lookup.
+        if button is not None and not sip.isdeleted(button):
+            button.setText(button_text)
+            button.setEnabled(True)
+
+        if error is not None:
+            showInfo("Dictionare lookup for %s failed: %s" % (word, error))
+        elif not infos:
+            showInfo("Dictionare has no results for %s." % word)
+        else:
+            insert_lookup_result(self, note, note_search_key, word, infos)
 
-    html = download_function(word_stripped)
-    main_containers = preliminary_extraction_function(html)
+    # `on_done` (and the editor and note it holds on to) is released when
+    # the thread is deleted, which is why it mustn't refer to the thread.
+    thread.connect(thread, SIGNAL("lookupDone"), on_done)
+    lookup_threads.add(thread)
+    thread.start()
 
-    infos = [flatten(final_extraction_function(html, cont))
-             for cont in main_containers]
 
-    result = None
-    if len(infos) > 1:
-        # We got more than one result in the server response. Try to
-        # resolve on our own by comparing the result (including
-        # diacritics) with what the user input; if there's no definite
-        # match, then ask the user.
-        for info in infos:
-            if compare_romanian_words(info[note_search_key], word):
-                result = info
-                break
+def insert_lookup_result(self, note, note_search_key, word, infos):
+    """
+    Write a finished lookup into `note`, asking the user to pick if there
+    are several results. Runs on the main thread.
+    """
 
-            if result is None:
-                keyed_results = {i[note_search_key]: i for i in infos}
-                decision = ask_user_word(keyed_results.keys())
+    result = match_result(infos, note_search_key, word)
+    if result is None:
+        # No definite match among the results; ask the user.
+        keyed_results = {i[note_search_key]: i for i in infos}
+        decision = ask_user_word(keyed_results.keys())
 
-                if decision is None:
-                    return
-                else:
-                    result = keyed_results[decision]
-    else:
-        result = infos[0]
+        if decision is None:
+            return
+        else:
+            result = keyed_results[decision]
+
+    insert_result(note, result)
+
+    if self.note is note and not sip.isdeleted(self.widget):
+        self.loadNote()
+    elif note.id:
+        # The editor moved on to another note while we were looking up.
+        note.flush()
+
+
+def match_result(infos, note_search_key, word):
+    """
+    Pick the result for `word` out of `infos`. If we got more than one
+    result in the server response, try to resolve on our own by comparing
+    each result (including diacritics) with what the user input.
+
+    Returns `None` if there's no definite match.
+    """
+
+    if len(infos) == 1:
+        return infos[0]
+
+    for info in infos:
+        if compare_romanian_words(info[note_search_key], word):
+            return info
+
+    return None
 
-    for field, val in result.items():
-        if field in self.note:
-            self.note[field] = val
 
-    self.loadNote()
+def insert_result(note, result):
+    for field, val in result.items():
+        if field in note:
+            note[field] = val
 
 
 def editor_download_and_insert_noun_info(self):
-    download_and_insert_info(self, 'headword.singular', download_noun_html,
-                             do_preliminary_noun_extraction, extract_noun_info)
+    download_and_insert_info(self, "dictionare_download_noun", 'noun')
 
 
 def editor_download_and_insert_verb_info(self):
-    download_and_insert_info(self, 'headword', download_verb_html,
-                             do_preliminary_verb_extraction, extract_verb_info)
+    download_and_insert_info(self, "dictionare_download_verb", 'verb')
 
 
 def editor_add_download_noun_icon(self):
@@ -66,7 +159,7 @@ def editor_add_download_noun_icon(self):
 
 
 def editor_add_download_verb_icon(self):
-    self._addButton("dictionare_download_noun",
+    self._addButton("dictionare_download_verb",
                     lambda self=self: editor_download_and_insert_verb_info(self),
         tip=u"Download verb conjugations from Dictionare", text=u"DV")
 
@@ -103,264 +196,200 @@ def compare_romanian_words(s1, s2):
     return s1 == s2
 
 
-addHook("setupEditorButtons", editor_add_download_noun_icon)
-addHook("setupEditorButtons", editor_add_download_verb_icon)
-
-
-###########################
-
-
-import operator
-import re
-import unicodedata
-import urllib
-
-from BSXPath import BSXPathEvaluator, XPathResult
-
-
-DICTIONARE_NOUN_PAGE_URL = "http://www.dictionare.com/phpdic/nouns.php?field0=%s"
-DICTIONARE_VERB_PAGE_URL = "http://www.dictionare.com/phpdic/verbs.php?field0=%s"
-
-
-def strip_accents(word):
-    return ''.join((c for c in unicodedata.normalize('NFD', word) if unicodedata.category(c) != 'Mn'))
-
-
-# Flatten a dictionary to one level, merging its keys so that they are
-# separated by dots.
-def flatten(d, delimiter='.', parent_key=''):
-    new = []
+def note_part_of_speech(note):
+    """
+    Guess which part of speech a note is for from its fields. Returns a key
+    of `PARTS_OF_SPEECH`, or `None` if the note has neither kind of
+    headword field.
+    """
 
-    for k, v in d.items():
-        k = parent_key + delimiter + k if parent_key else k
+    # Noun notes are checked first, as their fields are the more specific.
+    for part_of_speech in ('noun', 'verb'):
+        if PARTS_OF_SPEECH[part_of_speech] in note:
+            return part_of_speech
+    return None
 
-        if isinstance(v, dict):
-            new.extend(flatten(v, parent_key=k).items())
-        else:
-            new.append((k, v))
 
-    return dict(new)
+def batch_lookup(job):
+    part_of_speech, word, _ = job
+    return lookup_word(word, part_of_speech)
 
 
-def download_html(word, url_template):
+class BatchLookupThread(QThread):
     """
-    Download a noun declension information from Dictionare. Returns HTML
-    content parsed by BeautifulSoup.
+    Runs `batch_lookup` over `jobs` off the GUI thread, keeping up to
+    `BATCH_CONCURRENCY` lookups in flight. Emits "jobDone" with each job,
+    its results and the exception raised, if any, as it completes.
     """
 
-    url = url_template % word
-    handle = urllib.urlopen(url)
-    html = handle.read()
-    handle.close()
-
-    # Encoding
-    html = html.decode('iso8859_2').encode('utf-8')
-
-    # Aiming for minimum pain here.
-    # The comment syntax on this page is wrong.. :(
-    important_html = re.search('<!-- Start text --!>(.+)<!-- End text --!>',
-                               html, re.S).group(1)
+    def __init__(self, jobs):
+        QThread.__init__(self)
+        self.jobs = jobs
+        self.cancelled = False
 
-    # Parse as a fragment
-    parsed = BSXPathEvaluator('<html><body>%s</body></html>' % important_html)
+    def run(self):
+        results = imap_unordered(batch_lookup, self.jobs,
+                                 min(BATCH_CONCURRENCY, len(self.jobs)))
+        try:
+            for job, infos, error in results:
+                if self.cancelled:
+                    break
+                self.emit(SIGNAL("jobDone"), job, infos, error)
+        finally:
+            results.close()
 
-    return parsed
+    def cancel(self):
+        """
+        Stop once the lookup currently being waited on completes; no more
+        are started after that.
+        """
 
+        self.cancelled = True
 
-def download_noun_html(noun):
-    return download_html(noun, DICTIONARE_NOUN_PAGE_URL)
 
+# Running batch fills; each drops out once its thread has finished.
+batch_fills = set()
 
-def download_verb_html(verb):
-    return download_html(verb, DICTIONARE_VERB_PAGE_URL)
 
+class BatchFill(object):
+    """
+    Fills notes from Dictionare on a `BatchLookupThread`, with a progress
+    dialog that can cancel it. `jobs` are `(part of speech, word, notes)`
+    tuples. Notes are written back on the main thread as results arrive.
+    """
 
-def do_preliminary_noun_extraction(html):
+    def __init__(self, browser, jobs):
+        self.browser = browser
+        self.total = len(jobs)
+        (self.completed, self.filled) = (0, 0)
+        (self.ambiguous, self.failed) = ([], [])
+        self.reported = False
+
+        self.progress = QProgressDialog("Looking up words on Dictionare...",
+                                        "Cancel", 0, self.total, browser)
+        self.progress.setWindowModality(Qt.WindowModal)
+        self.progress.setMinimumDuration(0)
+
+        # Slots are bound methods, which PyQt holds weakly, so that the
+        # thread doesn't keep this alive past `batch_fills`.
+        self.thread = BatchLookupThread(jobs)
+        self.thread.connect(self.thread, SIGNAL("jobDone"),
+                            self.insert_results)
+        self.thread.connect(self.thread, SIGNAL("finished()"), self.finish)
+        self.progress.connect(self.progress, SIGNAL("canceled()"),
+                              self.cancel)
+
+    def start(self):
+        batch_fills.add(self)
+        self.progress.show()
+        self.thread.start()
+
+    def insert_results(self, job, infos, error):
+        if self.reported:
+            # Cancelled; the thread is only winding down.
+            return
+
+        self.completed += 1
+        self.progress.setValue(self.completed)
+        part_of_speech, word, notes = job
+
+        if error is not None or not infos:
+            self.failed.append(word)
+            return
+
+        note_search_key = PARTS_OF_SPEECH[part_of_speech]
+        for note in notes:
+            result = match_result(infos, note_search_key,
+                                  note[note_search_key].strip())
+            if result is None:
+                self.ambiguous.append(word)
+                continue
+
+            insert_result(note, result)
+            note.flush()
+            self.filled += 1
+
+    def cancel(self):
+        self.thread.cancel()
+        self.report()
+
+    def finish(self):
+        # finished() is emitted just before the thread stops running.
+        self.thread.wait()
+        self.report()
+        batch_fills.discard(self)
+
+    def report(self):
+        """
+        Close the progress dialog, refresh the browser and tell the user
+        how the fill went. Only the first call does anything.
+        """
+
+        if self.reported:
+            return
+        self.reported = True
+
+        self.progress.hide()
+        self.progress.deleteLater()
+
+        self.browser.model.reset()
+        mw.requireReset()
+
+        message = "Filled %d notes." % self.filled
+        if self.ambiguous:
+            message += ("\n\nSeveral results, none matching exactly (fill "
+                        "these from the editor): %s" % ", ".join(self.ambiguous))
+        if self.failed:
+            message += "\n\nLookup failed: %s" % ", ".join(self.failed)
+        if self.completed < self.total:
+            message += ("\n\nCancelled; %d words were not looked up."
+                        % (self.total - self.completed))
+        showInfo(message)
+
+
+def browser_fill_selected_notes(browser):
     """
-    Pull out a list of nouns displayed on the given page. This
-    function's return (element-by-element) should be passed to
-    `extract_noun_info`.
+    Fill every selected note from Dictionare, keeping up to
+    `BATCH_CONCURRENCY` lookups in flight. Notes sharing a headword share a
+    single lookup. The lookups run on a `BatchFill`, so the browser stays
+    responsive and the fill can be cancelled.
     """
 
-    main_noun_containers = html.getItemList('html/body/center[3]/center[1]/'
-                                            'table[1]/tbody[1]/tr[1]/td[1]'
-                                            '/center/table[1]/tbody[1]')
-    return main_noun_containers
+    jobs = {}
+    for nid in browser.selectedNotes():
+        note = mw.col.getNote(nid)
+        part_of_speech = note_part_of_speech(note)
+        if part_of_speech is None:
+            continue
 
+        word = note[PARTS_OF_SPEECH[part_of_speech]].strip()
+        if word:
+            key = (part_of_speech, normalize_headword(word))
+            jobs.setdefault(key, (part_of_speech, word, []))[2].append(note)
 
-def do_preliminary_verb_extraction(html):
-    """
-    Pull out a verb displayed on a given page. This function's return
-    should be passed to `extract_verb_info`.
-    """
+    if not jobs:
+        showInfo("None of the selected notes have a headword to look up.")
+        return
 
-    return [html.getFirstItem('html/body/center[3]/center[1]/table[1]/tbody[1]'
-                              '/tr[1]/td[1]/center[1]/table[1]/tbody[1]')]
+    mw.checkpoint("Fill from Dictionare")
+    BatchFill(browser, jobs.values()).start()
 
 
-def extract_noun_info(html, main_noun_container):
-    """
-    Build structured information about noun declensions from a
-    Dictionare noun page.
-    """
+def browser_add_fill_action(browser):
+    action = QAction("Fill from Dictionare", browser)
+    browser.connect(action, SIGNAL("triggered()"),
+                    lambda browser=browser: browser_fill_selected_notes(browser))
+    browser.form.menuEdit.addSeparator()
+    browser.form.menuEdit.addAction(action)
 
-    noun_data = {
-        'headword': {
-            'singular': None,
-            'plural': None,
-            'gender': None
-        },
-
-        'declensions': {
-            'indefinite': {
-                'singular': {'nominative': None, 'genitive': None, 'dative': None, 'accusative': None},
-                'plural': {'nominative': None, 'genitive': None, 'dative': None, 'accusative': None}
-            },
-            'definite': {
-                'singular': {'nominative': None, 'genitive': None, 'dative': None, 'accusative': None},
-                'plural': {'nominative': None, 'genitive': None, 'dative': None, 'accusative': None}
-            }
-        }
-    }
-
-    headword_container = html.getFirstItem('tr[1]/td[1]', main_noun_container)
-    plural_text = html.getFirstItem('b[2]', headword_container).text
-    gender_text = headword_container.findAll(text=True)[-1]
-
-    noun_data['headword']['singular'] = ( html.getFirstItem('b[1]/font/font',
-                                                            headword_container)
-                                          .findAll(text=True)[1] )
-    noun_data['headword']['plural'] = re.sub('^/ ', '', plural_text)
-    noun_data['headword']['gender'] = gender_text.strip()
-
-    declension_container = html.getFirstItem('tr[3]', main_noun_container)
-    indefinite_declensions = html.getFirstItem('td[1]/table/tbody/tr[1]',
-                                               declension_container)
-    definite_declensions = html.getFirstItem('td[2]/table/tbody/tr[1]',
-                                             declension_container)
-
-    # Cases are listed in the same order for all four article /
-    # plurality combinations. Let's save some typing.
-    case_index_pairs = {
-        'nominative': 0,
-        'genitive': 1,
-        'dative': 2,
-        'accusative': 3
-    }
-
-    # Grab all text nodes and pick out the indices we know to be correct
-    indefinite_singular_declensions = ( html.getFirstItem('td[1]',
-                                                          indefinite_declensions)
-                                        .findAll(text=True) )
-
-    for case, idx in case_index_pairs.items():
-        noun_data['declensions']['indefinite']['singular'][case] = indefinite_singular_declensions[3 + 2 * idx]
-
-    indefinite_plural_declensions = html.getFirstItem('td[2]', indefinite_declensions).findAll(text=True)
-    for case, idx in case_index_pairs.items():
-        noun_data['declensions']['indefinite']['plural'][case] = indefinite_plural_declensions[2 + 2 * idx]
-
-    definite_singular_declensions = html.getFirstItem('td[2]', definite_declensions).findAll(text=True)
-    for case, idx in case_index_pairs.items():
-        noun_data['declensions']['definite']['singular'][case] = definite_singular_declensions[3 + 2 * idx]
-
-    definite_plural_declensions = html.getFirstItem('td[3]', definite_declensions).findAll(text=True)
-    for case, idx in case_index_pairs.items():
-        noun_data['declensions']['definite']['plural'][case] = definite_plural_declensions[3 + 2 * idx]
-
-    return noun_data
-
-def extract_verb_info(html, main_verb_container):
-    """
-    Build a dict describing all of a verb's conjugations given rendered content.
-    """
 
-    verb_data = {
-        'headword': None,
-        'gerund': None,
-        'past_participle': None,
-        'conj': {
-            'ind': {
-                'prs': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'perfcomp': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'imperf': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'pastperf': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'future1': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'future2': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'future1pop': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'future2pop': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'future3pop': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'simpperf': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None}
-            },
-            'subj': {
-                'prs': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'perfcomp': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-            },
-            'cond': {
-                'prs': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-                'perf': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
-            },
-            'imp': {'2sg': None, '2pl': None}
-        }
-    }
-
-    headword_contents = html.getFirstItem('tr[1]', main_verb_container).findAll(text=True)
-    verb_data['headword'] = headword_contents[1]
-    verb_data['gerund'] = headword_contents[3].strip()
-    verb_data['past_participle'] = headword_contents[5]
-
-    # Describes the order in which conjugations appear in the page source
-    conj_order = ['ind.prs', 'ind.perfcomp', 'ind.imperf', 'ind.pastperf',
-                  'ind.simpperf', 'subj.prs', 'subj.perfcomp', 'imp',
-                  'ind.future1', 'ind.future2', 'ind.future1pop',
-                  'ind.future2pop', 'ind.future3pop', 'cond.prs', 'cond.perf']
-
-    # In some conjugations the verb is given first and in others the
-    # pronoun first. If we have a tuple for a given conjugation `(el0,
-    # el1)`, which is the verb?
-    verb_index = {
-        'ind.prs': 1,
-        'ind.perfcomp': 1,
-        'ind.imperf': 1,
-        'ind.pastperf': 1,
-        'ind.simpperf': 1,
-        'subj.prs': 0,
-        'subj.perfcomp': 0,
-        'imp': 0,
-        'ind.future1': 1,
-        'ind.future2': 1,
-        'ind.future1pop': 0,
-        'ind.future2pop': 0,
-        'ind.future3pop': 0,
-        'cond.prs': 1,
-        'cond.perf': 1
-    }
-
-    conjugation_pair_els = html.getItemList('tr[3]/td//table/tbody[1]/tr/td[count(font)>1]/font/font', main_verb_container)
-    conjugation_pronoun_pairs = [x.findAll(text=True) for x in conjugation_pair_els]
-    print conjugation_pronoun_pairs
-
-    # We'll move a window through the conjugation pair "stack." This
-    # cursor tracks the start of the window.
-    cursor = 0
-
-    for conj in conj_order:
-        # How many conjugations should we take off the stack?
-        take = 2 if conj == 'imp' else 6
-        pairs = conjugation_pronoun_pairs[cursor:cursor+take]
-        cursor += take
-
-        # Pick out the verbs from the pairs for this conjugation
-        verbs = [p[verb_index[conj]].strip() for p in pairs]
-
-        configurations = (['2sg', '2pl'] if conj == 'imp'
-                          else ['1sg', '2sg', '3sg', '1pl', '2pl', '3pl'])
-        conjugations = dict(zip(configurations, verbs))
-
-        if conj == 'imp':
-            verb_data['conj']['imp'] = conjugations
-        else:
-            p1, p2 = conj.split('.')
-            verb_data['conj'][p1][p2] = conjugations
+# For each part of speech we can look up, the note field holding the
+# headword.
+PARTS_OF_SPEECH = {
+    'noun': 'headword.singular',
+    'verb': 'headword',
+}
 
-    return verb_data
+addHook("setupEditorButtons", editor_add_download_noun_icon)
+addHook("setupEditorButtons", editor_add_download_verb_icon)
+addHook("browser.setupMenus", browser_add_fill_action)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import Queue
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Token-bucket rate limiter: allows `rate` acquisitions per second on
+    average, with bursts of up to `capacity`. Safe to share between
+    threads.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None
+                              else max(1, rate))
+
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+        """
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def imap_unordered(function, items, max_in_flight=8):
+    """
+    Apply `function` to each of `items` on up to `max_in_flight` worker
+    threads and yield `(item, result, error)` tuples as calls complete, so
+    the caller can process results while other calls are still waiting on
+    the network. `error` is the exception raised by the call, if any.
+
+    Items are consumed lazily; closing the generator early stops the
+    workers once their current call returns.
+    """
+
+    pending = Queue.Queue(maxsize=max_in_flight)
+    done = Queue.Queue()
+    stop = threading.Event()
+    finished = object()
+
+    def feed():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        pending.put(item, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        finally:
+            for _ in range(max_in_flight):
+                pending.put(finished)
+
+    def work():
+        while True:
+            item = pending.get()
+            if item is finished:
+                done.put(finished)
+                return
+            if stop.is_set():
+                continue
+
+            try:
+                done.put((item, function(item), None))
+            except Exception as e:
+                done.put((item, None, e))
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work)
+                   for _ in range(max_in_flight))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    running = max_in_flight
+    try:
+        while running:
+            result = done.get()
+            if result is finished:
+                running -= 1
+            else:
+                yield result
+    finally:
+        stop.set()
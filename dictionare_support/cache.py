@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+class DocumentCache(object):
+    """
+    In-memory LRU cache of parsed Dictionare documents, bounded both by
+    entry count and by an approximate byte size (the length of the HTML
+    each document was parsed from).
+    """
+
+    def __init__(self, max_entries=64, max_bytes=8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached document for `key` (marking it most recently
+        used), or `None` on a miss.
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, document, size):
+        """
+        Store `document` under `key`, evicting least recently used entries
+        until both bounds hold again. Documents larger than the whole byte
+        budget are not cached.
+        """
+
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self._entries[key] = (document, size)
+            self.size += size
+
+            while (len(self._entries) > self.max_entries
+                   or self.size > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class ResponseCache(object):
+    """
+    Persistent on-disk cache of raw HTTP responses keyed by URL.
+
+    Each entry is a single zlib-compressed file named after the SHA-1 of its
+    URL, prefixed with the time it was stored. Entries are written to a
+    temporary file and renamed into place, so readers (including other
+    threads or processes) only ever see complete entries and a crash never
+    leaves a truncated one behind. A hit touches the entry's mtime, which
+    drives LRU eviction once the directory exceeds `max_bytes`. Entries
+    older than `ttl` seconds are treated as misses; `ttl=None` never
+    expires.
+    """
+
+    HEADER = struct.Struct('!d')
+    TEMP_PREFIX = '.tmp-'
+
+    def __init__(self, directory, max_bytes=32 * 1024 * 1024,
+                 ttl=30 * 24 * 60 * 60, compress_level=6):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compress_level = compress_level
+        self.hits = 0
+        self.misses = 0
+
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(url).hexdigest())
+
+    def _ensure_directory(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _entries(self):
+        """
+        List `(path, size, mtime)` for every complete entry on disk.
+        """
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+
+        entries = []
+        for name in names:
+            if name.startswith(self.TEMP_PREFIX):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+
+        return entries
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def get(self, url):
+        """
+        Return the raw response body stored for `url`, or `None` if there
+        is no fresh entry.
+        """
+
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+
+        try:
+            (stored,) = self.HEADER.unpack_from(data)
+            body = zlib.decompress(data[self.HEADER.size:])
+        except (struct.error, zlib.error):
+            # Corrupt entry; drop it and refetch.
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        if self.ttl is not None and time.time() - stored > self.ttl:
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return body
+
+    def put(self, url, body):
+        """
+        Atomically store `body` (a byte string) as the response for `url`,
+        then evict least recently used entries beyond the size budget.
+
+        Failing to write the entry (read-only directory, full disk) is
+        logged and otherwise ignored; the cache just misses next time.
+        """
+
+        data = (self.HEADER.pack(time.time())
+                + zlib.compress(body, self.compress_level))
+        if len(data) > self.max_bytes:
+            return
+
+        try:
+            old_size = self._write(self._path(url), data)
+        except (IOError, OSError) as e:
+            log.warning('Could not cache the response for %s: %s', url, e)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += len(data) - old_size
+            over_budget = self._size > self.max_bytes
+
+        if over_budget:
+            self.evict()
+
+    def _write(self, path, data):
+        """
+        Write `data` to a temporary file and rename it into place at
+        `path`. Returns the size of the entry it replaced, if any.
+        """
+
+        self._ensure_directory()
+
+        fd, temp_path = tempfile.mkstemp(prefix=self.TEMP_PREFIX,
+                                         dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # Windows refuses to rename over an existing file.
+                os.remove(path)
+                os.rename(temp_path, path)
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        return old_size
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in
+        `max_bytes`.
+        """
+
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+        with self._lock:
+            self._size = total
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        with self._lock:
+            self._size = 0
+
+
+class ParadigmStore(object):
+    """
+    SQLite-backed store of extracted, `flatten()`ed paradigms keyed by part
+    of speech and normalized headword.
+
+    The database carries `version` in its `user_version` pragma. Opening a
+    database written with a different version discards its rows, so bumping
+    the version invalidates everything extracted by older extractors.
+
+    The store is only a cache: a database that can't be created, is locked
+    or is corrupt makes `get` miss and `put` do nothing (both log why).
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is not None:
+            return self._connection
+
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('CREATE TABLE IF NOT EXISTS paradigms ('
+                           ' part_of_speech TEXT NOT NULL,'
+                           ' headword TEXT NOT NULL,'
+                           ' infos TEXT NOT NULL,'
+                           ' stored REAL NOT NULL,'
+                           ' PRIMARY KEY (part_of_speech, headword))')
+
+        (version,) = connection.execute('PRAGMA user_version').fetchone()
+        if version != self.version:
+            connection.execute('DELETE FROM paradigms')
+            connection.execute('PRAGMA user_version = %d' % self.version)
+        connection.commit()
+
+        self._connection = connection
+        return connection
+
+    def get(self, part_of_speech, headword):
+        """
+        Return the list of flattened result dicts stored for `headword`, or
+        `None` if it hasn't been stored.
+        """
+
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT infos FROM paradigms'
+                    ' WHERE part_of_speech = ? AND headword = ?',
+                    (part_of_speech, headword)).fetchone()
+        except sqlite3.Error as e:
+            log.warning('Could not read paradigm store %s: %s', self.path, e)
+            return None
+
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, part_of_speech, headword, infos):
+        data = json.dumps(infos)
+
+        try:
+            with self._lock:
+                connection = self._connect()
+                connection.execute('INSERT OR REPLACE INTO paradigms'
+                                   ' VALUES (?, ?, ?, ?)',
+                                   (part_of_speech, headword, data,
+                                    time.time()))
+                connection.commit()
+        except sqlite3.Error as e:
+            log.warning('Could not write paradigm store %s: %s', self.path, e)
+
+    def clear(self):
+        with self._lock:
+            connection = self._connect()
+            connection.execute('DELETE FROM paradigms')
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
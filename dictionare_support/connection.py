@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import httplib
+import socket
+import threading
+import time
+
+
+class ConnectionPool(object):
+    """
+    Pool of persistent HTTP/1.1 connections to a single host.
+
+    At most `max_size` idle connections are kept; one that has sat idle
+    for longer than `idle_timeout` seconds is closed instead of reused,
+    since the server has most likely dropped it by then. Keep it below the
+    server's keep-alive timeout (Apache's default is 5 seconds). Safe to
+    share between threads.
+    """
+
+    def __init__(self, host, port=80, max_size=8, idle_timeout=4,
+                 timeout=30, drain_limit=16 * 1024):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.drain_limit = drain_limit
+
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        """
+        Return `(connection, reused)`, preferring the most recently used
+        idle connection.
+        """
+
+        now = time.time()
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return connection, True
+                connection.close()
+
+        return self._connect(), False
+
+    def _connect(self):
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def get(self, path, headers=None, read=None):
+        """
+        GET `path` and return `(status, body)`. A request that fails on a
+        reused connection, which the server has most likely closed, is
+        retried once on a new connection. Timeouts are not retried.
+
+        If given, `read(response)` produces the body instead of reading the
+        whole response. When it stops early, the rest of the response is
+        drained if it is no longer than `drain_limit` bytes, so the
+        connection can be reused; otherwise the connection is closed.
+        """
+
+        headers = dict(headers or {})
+
+        connection, reused = self._acquire()
+        while True:
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = read(response) if read else response.read()
+
+                if not response.isclosed() and not response.will_close:
+                    remaining = response.length
+                    if remaining is not None and remaining <= self.drain_limit:
+                        response.read()
+            except socket.timeout:
+                connection.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    # Not another pooled connection: it may be just as
+                    # stale.
+                    connection, reused = self._connect(), False
+                    continue
+                raise
+
+            if response.will_close or not response.isclosed():
+                connection.close()
+            else:
+                self._release(connection)
+
+            return response.status, body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            connection.close()
+
+
+def read_between(stream, start, end, chunk_size=8192):
+    """
+    Read `stream` in chunks and return the bytes between the first `start`
+    marker and the following `end` marker, without reading any further.
+    Nothing before `start` is kept. Returns `None` if either marker is
+    missing.
+    """
+
+    # Look for the start marker, keeping just enough of each chunk to
+    # catch a marker split across chunks.
+    tail = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return None
+
+        data = tail + chunk
+        index = data.find(start)
+        if index >= 0:
+            data = data[index + len(start):]
+            break
+        tail = data[-(len(start) - 1):] if len(start) > 1 else ''
+
+    parts = []
+    while True:
+        index = data.find(end)
+        if index >= 0:
+            parts.append(data[:index])
+            return ''.join(parts)
+
+        # Hold back a possible partial end marker.
+        keep = len(end) - 1
+        if len(data) > keep:
+            parts.append(data[:len(data) - keep])
+            data = data[len(data) - keep:]
+
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return None
+        data += chunk
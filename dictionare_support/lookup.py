@@ -0,0 +1,652 @@
+# -*- coding: utf-8 -*-
+
+"""
+Looking words up on Dictionare: downloading their pages, extracting noun
+declensions and verb conjugations, and caching the results along the way.
+Nothing here depends on Anki, so it also runs headless: see `bulk_lookup`,
+or run this module with a part of speech and some words.
+"""
+
+import json
+import operator
+import optparse
+import os
+import re
+import sys
+import unicodedata
+import urllib
+import urlparse
+
+from BeautifulSoup import BeautifulSoup
+from BSXPath import BSXPathEvaluator, XPathQuery, XPathResult
+from bulk import TokenBucket, imap_unordered
+from cache import DocumentCache, ParadigmStore, ResponseCache
+from connection import ConnectionPool, read_between
+from lxmlxpath import LXMLXPathEvaluator, lxml_available
+from streaming import StreamQuery, UnsupportedMarkup
+
+
+DICTIONARE_NOUN_PAGE_URL = "http://www.dictionare.com/phpdic/nouns.php?field0=%s"
+DICTIONARE_VERB_PAGE_URL = "http://www.dictionare.com/phpdic/verbs.php?field0=%s"
+
+# Aiming for minimum pain here: we only want what's between these.
+# The comment syntax on this page is wrong.. :(
+START_TEXT_MARKER = '<!-- Start text --!>'
+END_TEXT_MARKER = '<!-- End text --!>'
+
+# Keep-alive connections to Dictionare, shared by every lookup.
+DICTIONARE_HOST = "www.dictionare.com"
+CONNECTION_POOL_SIZE = 8
+CONNECTION_IDLE_TIMEOUT = 4
+
+connection_pool = ConnectionPool(DICTIONARE_HOST,
+                                 max_size=CONNECTION_POOL_SIZE,
+                                 idle_timeout=CONNECTION_IDLE_TIMEOUT)
+
+# Cap on requests per second sent to Dictionare, however many lookups are
+# in flight.
+DICTIONARE_MAX_REQUESTS_PER_SECOND = 4
+
+request_rate_limiter = TokenBucket(DICTIONARE_MAX_REQUESTS_PER_SECOND)
+
+# XPath queries used by the extractors below, compiled once at import.
+NOUN_CONTAINERS_XPATH = XPathQuery('html/body/center[3]/center[1]/table[1]'
+                                   '/tbody[1]/tr[1]/td[1]/center/table[1]'
+                                   '/tbody[1]')
+NOUN_HEADWORD_XPATH = XPathQuery('tr[1]/td[1]')
+NOUN_PLURAL_XPATH = XPathQuery('b[2]')
+NOUN_SINGULAR_XPATH = XPathQuery('b[1]/font/font')
+NOUN_DECLENSIONS_XPATH = XPathQuery('tr[3]')
+NOUN_INDEFINITE_XPATH = XPathQuery('td[1]/table/tbody/tr[1]')
+NOUN_DEFINITE_XPATH = XPathQuery('td[2]/table/tbody/tr[1]')
+TD1_XPATH = XPathQuery('td[1]')
+TD2_XPATH = XPathQuery('td[2]')
+TD3_XPATH = XPathQuery('td[3]')
+
+VERB_CONTAINER_XPATH = XPathQuery('html/body/center[3]/center[1]/table[1]'
+                                  '/tbody[1]/tr[1]/td[1]/center[1]/table[1]'
+                                  '/tbody[1]')
+VERB_HEADWORD_XPATH = XPathQuery('tr[1]')
+VERB_CONJUGATION_PAIRS_XPATH = XPathQuery('tr[3]/td//table/tbody[1]/tr'
+                                          '/td[count(font)>1]/font/font')
+
+# The same queries for the streaming backend, nested the way the extractors
+# use them: each is looked for below the first match of its parent.
+NOUN_PLURAL_STREAM = StreamQuery('b[2]', texts=True)
+NOUN_SINGULAR_STREAM = StreamQuery('b[1]/font/font', texts=True)
+NOUN_HEADWORD_STREAM = StreamQuery('tr[1]/td[1]', texts=True,
+                                   children=[NOUN_PLURAL_STREAM,
+                                             NOUN_SINGULAR_STREAM])
+TD1_STREAM = StreamQuery('td[1]', texts=True)
+TD2_STREAM = StreamQuery('td[2]', texts=True)
+TD3_STREAM = StreamQuery('td[3]', texts=True)
+NOUN_INDEFINITE_STREAM = StreamQuery('td[1]/table/tbody/tr[1]',
+                                     children=[TD1_STREAM, TD2_STREAM])
+NOUN_DEFINITE_STREAM = StreamQuery('td[2]/table/tbody/tr[1]',
+                                   children=[TD2_STREAM, TD3_STREAM])
+NOUN_DECLENSIONS_STREAM = StreamQuery('tr[3]',
+                                      children=[NOUN_INDEFINITE_STREAM,
+                                                NOUN_DEFINITE_STREAM])
+NOUN_CONTAINERS_STREAM = StreamQuery(NOUN_CONTAINERS_XPATH.source,
+                                     children=[NOUN_HEADWORD_STREAM,
+                                               NOUN_DECLENSIONS_STREAM])
+
+VERB_HEADWORD_STREAM = StreamQuery('tr[1]', texts=True)
+VERB_CONJUGATION_PAIRS_STREAM = StreamQuery(VERB_CONJUGATION_PAIRS_XPATH.source,
+                                            texts=True)
+VERB_CONTAINER_STREAM = StreamQuery(VERB_CONTAINER_XPATH.source,
+                                    children=[VERB_HEADWORD_STREAM,
+                                              VERB_CONJUGATION_PAIRS_STREAM])
+
+# Document class pages are parsed into: lxml's when it's installed, as it
+# is much faster, otherwise BSXPath's. The extractors run on either.
+XPATH_EVALUATOR = LXMLXPathEvaluator if lxml_available else BSXPathEvaluator
+
+# Character and entity references in pages are decoded, as libxml2 always
+# does, so that every backend extracts the same text.
+CONVERT_ENTITIES = BeautifulSoup.HTML_ENTITIES
+
+# Parsed pages, keyed by (URL template, stripped word), so that repeat
+# lookups skip the download and the parse entirely.
+DOCUMENT_CACHE_MAX_ENTRIES = 64
+DOCUMENT_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+document_cache = DocumentCache(DOCUMENT_CACHE_MAX_ENTRIES,
+                               DOCUMENT_CACHE_MAX_BYTES)
+
+# Dictionary text of each response, compressed on disk and keyed by URL, so
+# that restarting Anki doesn't mean hitting the network again.
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+RESPONSE_CACHE_DIR = os.path.join(ADDON_DIR, 'response_cache')
+RESPONSE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+RESPONSE_CACHE_TTL = 30 * 24 * 60 * 60
+
+response_cache = ResponseCache(RESPONSE_CACHE_DIR, RESPONSE_CACHE_MAX_BYTES,
+                               RESPONSE_CACHE_TTL)
+
+# Final extracted results, so a known word fills a note without building a
+# DOM at all. Bump the version whenever the extractors' output changes.
+PARADIGM_STORE_PATH = os.path.join(ADDON_DIR, 'paradigms.sqlite')
+PARADIGM_STORE_VERSION = 3
+
+paradigm_store = ParadigmStore(PARADIGM_STORE_PATH, PARADIGM_STORE_VERSION)
+
+
+def strip_accents(word):
+    return ''.join((c for c in unicodedata.normalize('NFD', word) if unicodedata.category(c) != 'Mn'))
+
+
+def normalize_headword(word):
+    return strip_accents(word).strip().lower()
+
+
+# Flatten a dictionary to one level, merging its keys so that they are
+# separated by dots.
+def flatten(d, delimiter='.', parent_key=''):
+    new = []
+
+    for k, v in d.items():
+        k = parent_key + delimiter + k if parent_key else k
+
+        if isinstance(v, dict):
+            new.extend(flatten(v, parent_key=k).items())
+        else:
+            new.append((k, v))
+
+    return dict(new)
+
+
+def fetch_dictionary_text(url):
+    """
+    Return the dictionary text of the page at `url`: the raw (iso8859_2)
+    bytes between its start and end text markers. The response is read
+    only up to the end marker.
+
+    Served from `response_cache` when a fresh copy is on disk. Requests to
+    Dictionare go over `connection_pool`, throttled by
+    `request_rate_limiter`.
+    """
+
+    text = response_cache.get(url)
+    if text is not None:
+        return text
+
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+
+    read = lambda response: read_between(response, START_TEXT_MARKER,
+                                         END_TEXT_MARKER)
+
+    parts = urlparse.urlsplit(url)
+    if parts.hostname == connection_pool.host:
+        path = urllib.quote(parts.path, safe='/%')
+        if parts.query:
+            path += '?' + urllib.quote(parts.query, safe='=&%')
+
+        request_rate_limiter.acquire()
+        status, text = connection_pool.get(path, read=read)
+        if status != 200:
+            raise IOError('HTTP error %d fetching %s' % (status, url))
+    else:
+        handle = urllib.urlopen(url)
+        text = read(handle)
+        handle.close()
+
+    if not text:
+        raise IOError('No dictionary text in response from %s' % url)
+
+    response_cache.put(url, text)
+    return text
+
+
+def download_html(word, url_template):
+    """
+    Download a noun declension information from Dictionare. Returns HTML
+    content parsed into an `XPATH_EVALUATOR` document.
+
+    Parsed documents are kept in `document_cache`; a repeat lookup of the
+    same word on the same endpoint returns the cached document.
+    """
+
+    cache_key = (url_template, word)
+    cached = document_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Parse as a fragment
+    markup = download_markup(word, url_template)
+    parsed = parse_markup(markup)
+    document_cache.put(cache_key, parsed, len(markup))
+
+    return parsed
+
+
+def parse_markup(markup):
+    """
+    Parse `markup` into an `XPATH_EVALUATOR` document.
+    """
+
+    if XPATH_EVALUATOR is BSXPathEvaluator:
+        return BSXPathEvaluator(markup, convertEntities=CONVERT_ENTITIES)
+    return XPATH_EVALUATOR(markup)
+
+
+def download_markup(word, url_template):
+    """
+    Download the dictionary text of a Dictionare page, wrapped up as the
+    (unicode) HTML document `download_html` parses.
+    """
+
+    return dictionary_markup(fetch_dictionary_text(url_template % word))
+
+
+def dictionary_markup(text):
+    """
+    Wrap the dictionary text of a page (as returned by
+    `fetch_dictionary_text`) up as a unicode HTML document.
+    """
+
+    # Encoding. Handing BeautifulSoup unicode skips its own charset
+    # detection.
+    important_html = text.decode('iso8859_2')
+
+    return u'<html><body>%s</body></html>' % important_html
+
+
+def download_noun_html(noun):
+    return download_html(noun, DICTIONARE_NOUN_PAGE_URL)
+
+
+def download_verb_html(verb):
+    return download_html(verb, DICTIONARE_VERB_PAGE_URL)
+
+
+def download_noun_markup(noun):
+    return download_markup(noun, DICTIONARE_NOUN_PAGE_URL)
+
+
+def download_verb_markup(verb):
+    return download_markup(verb, DICTIONARE_VERB_PAGE_URL)
+
+
+def lookup_word(word, part_of_speech, backend=None):
+    """
+    Return a list of flattened result dicts for `word`, one per entry on
+    the Dictionare page. Results are served from `paradigm_store` when the
+    word has been looked up before.
+
+    `backend` picks the entry of `EXTRACTION_BACKENDS` used to download and
+    extract the page; it defaults to `EXTRACTION_BACKEND`.
+    """
+
+    headword = normalize_headword(word)
+    infos = paradigm_store.get(part_of_speech, headword)
+    if infos is not None:
+        return infos
+
+    backends = EXTRACTION_BACKENDS[backend or EXTRACTION_BACKEND]
+    download_function, extraction_function = backends[part_of_speech]
+
+    document = download_function(strip_accents(word))
+    infos = [flatten(info) for info in extraction_function(document)]
+
+    if infos:
+        paradigm_store.put(part_of_speech, headword, infos)
+    return infos
+
+
+# Lookups `bulk_lookup` keeps in flight at once by default.
+BULK_CONCURRENCY = 8
+
+
+def bulk_lookup(words, part_of_speech, max_in_flight=BULK_CONCURRENCY,
+                backend=None):
+    """
+    Look up each of `words` with `lookup_word`, keeping up to
+    `max_in_flight` lookups going at once, and yield `(word, infos, error)`
+    tuples as they complete. Requests stay within `request_rate_limiter`.
+    """
+
+    return imap_unordered(
+        lambda word: lookup_word(word, part_of_speech, backend),
+        words, max_in_flight)
+
+
+def do_preliminary_noun_extraction(html):
+    """
+    Pull out a list of nouns displayed on the given page. This
+    function's return (element-by-element) should be passed to
+    `extract_noun_info`.
+    """
+
+    main_noun_containers = NOUN_CONTAINERS_XPATH.all(html)
+    return main_noun_containers
+
+
+def do_preliminary_verb_extraction(html):
+    """
+    Pull out a verb displayed on a given page. This function's return
+    should be passed to `extract_verb_info`.
+    """
+
+    return [VERB_CONTAINER_XPATH.first(html)]
+
+
+def extract_noun_info(html, main_noun_container):
+    """
+    Build structured information about noun declensions from a
+    Dictionare noun page.
+    """
+
+    headword_container = NOUN_HEADWORD_XPATH.first(html, main_noun_container)
+    declension_container = NOUN_DECLENSIONS_XPATH.first(html,
+                                                         main_noun_container)
+    indefinite_declensions = NOUN_INDEFINITE_XPATH.first(html,
+                                                         declension_container)
+    definite_declensions = NOUN_DEFINITE_XPATH.first(html,
+                                                     declension_container)
+
+    return build_noun_info({
+        'headword': headword_container.findAll(text=True),
+        'plural': NOUN_PLURAL_XPATH.first(html, headword_container).text,
+        'singular': NOUN_SINGULAR_XPATH.first(html, headword_container)
+                                       .findAll(text=True),
+        'indefinite_singular': TD1_XPATH.first(html, indefinite_declensions)
+                                        .findAll(text=True),
+        'indefinite_plural': TD2_XPATH.first(html, indefinite_declensions)
+                                      .findAll(text=True),
+        'definite_singular': TD2_XPATH.first(html, definite_declensions)
+                                      .findAll(text=True),
+        'definite_plural': TD3_XPATH.first(html, definite_declensions)
+                                    .findAll(text=True),
+    })
+
+
+def stream_noun_info(main_noun_container):
+    """
+    Streaming counterpart of `extract_noun_info`, taking a match of
+    `NOUN_CONTAINERS_STREAM`.
+    """
+
+    headword_container = main_noun_container.first(NOUN_HEADWORD_STREAM)
+    declension_container = main_noun_container.first(NOUN_DECLENSIONS_STREAM)
+    indefinite_declensions = declension_container.first(NOUN_INDEFINITE_STREAM)
+    definite_declensions = declension_container.first(NOUN_DEFINITE_STREAM)
+
+    return build_noun_info({
+        'headword': headword_container.texts,
+        'plural': headword_container.first(NOUN_PLURAL_STREAM).text,
+        'singular': headword_container.first(NOUN_SINGULAR_STREAM).texts,
+        'indefinite_singular': indefinite_declensions.first(TD1_STREAM).texts,
+        'indefinite_plural': indefinite_declensions.first(TD2_STREAM).texts,
+        'definite_singular': definite_declensions.first(TD2_STREAM).texts,
+        'definite_plural': definite_declensions.first(TD3_STREAM).texts,
+    })
+
+
+def build_noun_info(texts):
+    """
+    Build the noun declension dict from the text nodes of a noun entry,
+    as gathered by `extract_noun_info` or `stream_noun_info`.
+    """
+
+    noun_data = {
+        'headword': {
+            'singular': None,
+            'plural': None,
+            'gender': None
+        },
+
+        'declensions': {
+            'indefinite': {
+                'singular': {'nominative': None, 'genitive': None, 'dative': None, 'accusative': None},
+                'plural': {'nominative': None, 'genitive': None, 'dative': None, 'accusative': None}
+            },
+            'definite': {
+                'singular': {'nominative': None, 'genitive': None, 'dative': None, 'accusative': None},
+                'plural': {'nominative': None, 'genitive': None, 'dative': None, 'accusative': None}
+            }
+        }
+    }
+
+    plural_text = texts['plural']
+    gender_text = texts['headword'][-1]
+
+    noun_data['headword']['singular'] = texts['singular'][1]
+    noun_data['headword']['plural'] = re.sub('^/ ', '', plural_text)
+    noun_data['headword']['gender'] = gender_text.strip()
+
+    # Cases are listed in the same order for all four article /
+    # plurality combinations. Let's save some typing.
+    case_index_pairs = {
+        'nominative': 0,
+        'genitive': 1,
+        'dative': 2,
+        'accusative': 3
+    }
+
+    # Grab all text nodes and pick out the indices we know to be correct
+    indefinite_singular_declensions = texts['indefinite_singular']
+
+    for case, idx in case_index_pairs.items():
+        noun_data['declensions']['indefinite']['singular'][case] = indefinite_singular_declensions[3 + 2 * idx]
+
+    indefinite_plural_declensions = texts['indefinite_plural']
+    for case, idx in case_index_pairs.items():
+        noun_data['declensions']['indefinite']['plural'][case] = indefinite_plural_declensions[2 + 2 * idx]
+
+    definite_singular_declensions = texts['definite_singular']
+    for case, idx in case_index_pairs.items():
+        noun_data['declensions']['definite']['singular'][case] = definite_singular_declensions[3 + 2 * idx]
+
+    definite_plural_declensions = texts['definite_plural']
+    for case, idx in case_index_pairs.items():
+        noun_data['declensions']['definite']['plural'][case] = definite_plural_declensions[3 + 2 * idx]
+
+    return noun_data
+
+def extract_verb_info(html, main_verb_container):
+    """
+    Build a dict describing all of a verb's conjugations given rendered content.
+    """
+
+    conjugation_pair_els = VERB_CONJUGATION_PAIRS_XPATH.all(html, main_verb_container)
+
+    return build_verb_info({
+        'headword': VERB_HEADWORD_XPATH.first(html, main_verb_container)
+                                       .findAll(text=True),
+        'conjugation_pairs': [x.findAll(text=True)
+                              for x in conjugation_pair_els],
+    })
+
+
+def stream_verb_info(main_verb_container):
+    """
+    Streaming counterpart of `extract_verb_info`, taking a match of
+    `VERB_CONTAINER_STREAM`.
+    """
+
+    conjugation_pair_els = main_verb_container.all(VERB_CONJUGATION_PAIRS_STREAM)
+
+    return build_verb_info({
+        'headword': main_verb_container.first(VERB_HEADWORD_STREAM).texts,
+        'conjugation_pairs': [x.texts for x in conjugation_pair_els],
+    })
+
+
+def build_verb_info(texts):
+    """
+    Build the verb conjugation dict from the text nodes of a verb entry,
+    as gathered by `extract_verb_info` or `stream_verb_info`.
+    """
+
+    verb_data = {
+        'headword': None,
+        'gerund': None,
+        'past_participle': None,
+        'conj': {
+            'ind': {
+                'prs': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'perfcomp': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'imperf': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'pastperf': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'future1': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'future2': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'future1pop': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'future2pop': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'future3pop': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'simpperf': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None}
+            },
+            'subj': {
+                'prs': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'perfcomp': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+            },
+            'cond': {
+                'prs': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+                'perf': {'1sg': None, '2sg': None, '3sg': None, '1pl': None, '2pl': None, '3pl': None},
+            },
+            'imp': {'2sg': None, '2pl': None}
+        }
+    }
+
+    headword_contents = texts['headword']
+    verb_data['headword'] = headword_contents[1]
+    verb_data['gerund'] = headword_contents[3].strip()
+    verb_data['past_participle'] = headword_contents[5]
+
+    # Describes the order in which conjugations appear in the page source
+    conj_order = ['ind.prs', 'ind.perfcomp', 'ind.imperf', 'ind.pastperf',
+                  'ind.simpperf', 'subj.prs', 'subj.perfcomp', 'imp',
+                  'ind.future1', 'ind.future2', 'ind.future1pop',
+                  'ind.future2pop', 'ind.future3pop', 'cond.prs', 'cond.perf']
+
+    # In some conjugations the verb is given first and in others the
+    # pronoun first. If we have a tuple for a given conjugation `(el0,
+    # el1)`, which is the verb?
+    verb_index = {
+        'ind.prs': 1,
+        'ind.perfcomp': 1,
+        'ind.imperf': 1,
+        'ind.pastperf': 1,
+        'ind.simpperf': 1,
+        'subj.prs': 0,
+        'subj.perfcomp': 0,
+        'imp': 0,
+        'ind.future1': 1,
+        'ind.future2': 1,
+        'ind.future1pop': 0,
+        'ind.future2pop': 0,
+        'ind.future3pop': 0,
+        'cond.prs': 1,
+        'cond.perf': 1
+    }
+
+    conjugation_pronoun_pairs = texts['conjugation_pairs']
+
+    # We'll move a window through the conjugation pair "stack." This
+    # cursor tracks the start of the window.
+    cursor = 0
+
+    for conj in conj_order:
+        # How many conjugations should we take off the stack?
+        take = 2 if conj == 'imp' else 6
+        pairs = conjugation_pronoun_pairs[cursor:cursor+take]
+        cursor += take
+
+        # Pick out the verbs from the pairs for this conjugation
+        verbs = [p[verb_index[conj]].strip() for p in pairs]
+
+        configurations = (['2sg', '2pl'] if conj == 'imp'
+                          else ['1sg', '2sg', '3sg', '1pl', '2pl', '3pl'])
+        conjugations = dict(zip(configurations, verbs))
+
+        if conj == 'imp':
+            verb_data['conj']['imp'] = conjugations
+        else:
+            p1, p2 = conj.split('.')
+            verb_data['conj'][p1][p2] = conjugations
+
+    return verb_data
+
+
+def extract_nouns(html):
+    return [extract_noun_info(html, cont)
+            for cont in do_preliminary_noun_extraction(html)]
+
+
+def extract_verbs(html):
+    return [extract_verb_info(html, cont)
+            for cont in do_preliminary_verb_extraction(html)]
+
+
+def stream_nouns(markup):
+    try:
+        main_containers = NOUN_CONTAINERS_STREAM.all(markup, CONVERT_ENTITIES)
+    except UnsupportedMarkup:
+        return extract_nouns(parse_markup(markup))
+
+    return [stream_noun_info(cont) for cont in main_containers]
+
+
+def stream_verbs(markup):
+    try:
+        main_container = VERB_CONTAINER_STREAM.first(markup, CONVERT_ENTITIES)
+    except UnsupportedMarkup:
+        return extract_verbs(parse_markup(markup))
+
+    return [stream_verb_info(main_container)]
+
+
+# Ways of getting from a word to its entries: for each part of speech, a
+# download function and a function extracting the entries from what it
+# returns. 'xpath' parses the page and queries the document; 'stream'
+# picks the same text out in a single pass over the markup, without
+# building a document (see `streaming`).
+EXTRACTION_BACKENDS = {
+    'xpath': {
+        'noun': (download_noun_html, extract_nouns),
+        'verb': (download_verb_html, extract_verbs),
+    },
+    'stream': {
+        'noun': (download_noun_markup, stream_nouns),
+        'verb': (download_verb_markup, stream_verbs),
+    },
+}
+
+EXTRACTION_BACKEND = 'xpath'
+
+
+if __name__ == '__main__':
+    optparser = optparse.OptionParser(
+        usage='%prog [options] noun|verb [word ...]',
+        description='Look up words on Dictionare (read one per line from '
+                    'standard input if none are given) and print each '
+                    'result as a line of JSON, in the order they complete.')
+    optparser.add_option('-j', '--jobs', type='int', default=BULK_CONCURRENCY,
+                         help='lookups in flight at once [%default]')
+    optparser.add_option('-b', '--backend', choices=EXTRACTION_BACKENDS.keys(),
+                         default=EXTRACTION_BACKEND,
+                         help='extraction backend [%default]')
+    (options, args) = optparser.parse_args()
+
+    if not args or args[0] not in EXTRACTION_BACKENDS[options.backend]:
+        optparser.error('the first argument must be noun or verb')
+
+    words = [word.decode(sys.getfilesystemencoding()) for word in args[1:]]
+    if not words:
+        encoding = sys.stdin.encoding or 'utf-8'
+        words = (line.decode(encoding).strip() for line in sys.stdin)
+        words = (word for word in words if word)
+
+    failed = 0
+    for word, infos, error in bulk_lookup(words, args[0], options.jobs,
+                                          options.backend):
+        if error is not None:
+            failed += 1
+            sys.stderr.write('%s: %s\n' % (word.encode('utf-8'), error))
+        else:
+            print json.dumps({'word': word, 'results': infos})
+            sys.stdout.flush()
+
+    sys.exit(1 if failed else 0)
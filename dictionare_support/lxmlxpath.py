@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+"""
+An lxml-backed stand-in for `BSXPathEvaluator`: pages are parsed by
+libxml2's HTML parser and queried with its native XPath, which is much
+faster than BeautifulSoup and BSXPath.
+
+`LXMLXPathEvaluator` has the same `evaluate`/`getItemList`/`getFirstItem`
+surface (and works with `XPathQuery`), and returns `LXMLNode`s that offer
+BeautifulSoup's `findAll(text=True)` and `text`. Tables are fixed up the
+way `BSXPathEvaluator` does it, so the same expressions find the same
+nodes. Unlike BeautifulSoup, libxml2 decodes entity references in text.
+
+lxml is optional; check `lxml_available` before using this module.
+"""
+
+import threading
+
+from BSXPath import XPathQuery, XPathResult
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+lxml_available = etree is not None
+
+STRIP_ASCII_SPACES = {9: None, 10: None, 12: None, 13: None, 32: None}
+PRESERVE_WHITESPACE_TAGS = ('pre', 'textarea')
+
+# Compiled expressions by source, per thread, since lxml's XPath objects
+# aren't meant to be shared between threads.
+_compiled = threading.local()
+
+
+def compile_xpath(source):
+    cache = getattr(_compiled, 'cache', None)
+    if cache is None:
+        cache = _compiled.cache = {}
+
+    xpath = cache.get(source)
+    if xpath is None:
+        xpath = cache[source] = etree.XPath(source)
+    return xpath
+
+
+class LXMLNode(object):
+    """
+    An element of an `LXMLXPathEvaluator` document, with the parts of
+    BeautifulSoup's `Tag` interface the extractors use.
+    """
+
+    def __init__(self, document, element):
+        self.document = document
+        self.element = element
+
+    @property
+    def name(self):
+        return self.element.tag
+
+    @property
+    def attrs(self):
+        return self.element.items()
+
+    @property
+    def text(self):
+        return u''.join(text.strip() for text in self.findAll(text=True))
+
+    def get(self, key, default=None):
+        return self.element.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.element.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def findAll(self, name=None, text=None):
+        """
+        With `text=True`, return the text nodes below this element, split
+        and whitespace-collapsed as BeautifulSoup would. Otherwise return
+        the descendant elements named `name` (any element if `None`).
+        """
+
+        if text:
+            return self.document.texts(self.element)
+
+        return [LXMLNode(self.document, element)
+                for element in self.element.iterdescendants(name or '*')]
+
+    def __eq__(self, other):
+        return (isinstance(other, LXMLNode)
+                and self.element is other.element)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.element)
+
+    def __unicode__(self):
+        return etree.tostring(self.element, encoding=unicode, with_tail=False)
+
+    def __repr__(self):
+        return '<LXMLNode %s>' % self.element.tag
+
+
+class _NodeList(list):
+    """
+    lxml's node-set results, in the shape `XPathResult` expects of a
+    BSXPath `NodeSet`.
+    """
+
+    isNodeSet = True
+
+    @property
+    def length(self):
+        return len(self)
+
+    def first(self):
+        return self[0] if self else None
+
+    def list(self):
+        return self
+
+    def string(self):
+        if not self:
+            return u''
+        node = self[0]
+        if isinstance(node, LXMLNode):
+            return unicode(node.element.xpath('string()'))
+        return unicode(node)
+
+    def number(self):
+        try:
+            return float(self.string())
+        except ValueError:
+            return float('nan')
+
+    def bool(self):
+        return bool(self)
+
+
+class LXMLXPathEvaluator(object):
+    """
+    Parse `markup` (unicode, or bytes in `fromEncoding`) into a document
+    queried like a `BSXPathEvaluator`.
+
+    The document node is stood in for by a `document` element wrapping the
+    page, so relative expressions (`html/body/...`) evaluate from it as
+    they would from BeautifulSoup's document, but absolute ones
+    (`/html/body/...`) do not.
+    """
+
+    def __init__(self, markup, fromEncoding=None):
+        if etree is None:
+            raise ImportError('lxml is not installed')
+
+        parser = etree.HTMLParser(encoding=fromEncoding)
+        root = etree.fromstring(markup, parser)
+
+        self.root = etree.Element('document')
+        if root is not None:
+            self.root.append(root)
+
+        # Text split up by `_fix_tables` moving table content around, as
+        # {(element, 'text' or 'tail'): [strings]}. Keeping the elements
+        # here also keeps their proxies (and so their identity) alive.
+        self._segments = {}
+        self._fix_tables()
+
+    def _fix_tables(self):
+        """
+        Wrap rows and cells sitting directly in a table in `tbody`/`tr`,
+        and move anything else in there in front of the table, as
+        `BSXPathEvaluator._fix_table` does.
+        """
+
+        for table in list(self.root.iter('table')):
+            if table.getparent() is None:
+                continue
+
+            self._move_before(table, self._pop_text(table, 'text'))
+
+            (tbody, tr) = (None, None)
+            for node in list(table):
+                tail = self._pop_text(node, 'tail')
+                name = node.tag
+
+                if name in ('thead', 'tbody', 'tfoot'):
+                    (tbody, tr) = (None, None)
+                elif name == 'tr':
+                    tr = None
+                    if tbody is None:
+                        tbody = etree.Element('tbody')
+                        node.addprevious(tbody)
+                    tbody.append(node)
+                elif name in ('th', 'td'):
+                    if tbody is None:
+                        tbody = etree.Element('tbody')
+                        node.addprevious(tbody)
+                    if tr is None:
+                        tr = etree.SubElement(tbody, 'tr')
+                    tr.append(node)
+                else:
+                    table.addprevious(node)
+
+                self._move_before(table, tail)
+
+    def _get_segments(self, element, attr):
+        segments = self._segments.get((element, attr))
+        if segments is None:
+            value = getattr(element, attr)
+            segments = [value] if value else []
+        return segments
+
+    def _pop_text(self, element, attr):
+        segments = self._get_segments(element, attr)
+        self._segments.pop((element, attr), None)
+        setattr(element, attr, None)
+        return segments
+
+    def _move_before(self, table, segments):
+        """
+        Put the text `segments` right in front of `table`, keeping each a
+        separate text node.
+        """
+
+        if not segments:
+            return
+
+        previous = table.getprevious()
+        if previous is None:
+            (element, attr) = (table.getparent(), 'text')
+        else:
+            (element, attr) = (previous, 'tail')
+
+        segments = self._get_segments(element, attr) + segments
+        self._segments[(element, attr)] = segments
+        setattr(element, attr, u''.join(segments))
+
+    def texts(self, element):
+        """
+        Return the text nodes below `element` in document order, comments
+        included, as BeautifulSoup's `findAll(text=True)` would.
+        """
+
+        preserve = any(ancestor.tag in PRESERVE_WHITESPACE_TAGS
+                       for ancestor in element.iterancestors())
+        texts = []
+        self._collect_texts(element, preserve, texts)
+        return texts
+
+    def _collect_texts(self, element, preserve, texts):
+        if not isinstance(element.tag, basestring):
+            # A comment or processing instruction is one text node.
+            if element.text:
+                texts.append(unicode(element.text))
+            return
+
+        preserve = preserve or element.tag in PRESERVE_WHITESPACE_TAGS
+        self._add_texts(element, 'text', preserve, texts)
+        for child in element:
+            self._collect_texts(child, preserve, texts)
+            self._add_texts(child, 'tail', preserve, texts)
+
+    def _add_texts(self, element, attr, preserve, texts):
+        for text in self._get_segments(element, attr):
+            text = unicode(text)
+            if not preserve and text.translate(STRIP_ASCII_SPACES) == u'':
+                text = u'\n' if u'\n' in text else u' '
+            texts.append(text)
+
+    def _context(self, context):
+        context = XPathQuery.contextNode(self, context)
+        if context is self:
+            return self.root
+        if isinstance(context, LXMLNode):
+            return context.element
+        return context
+
+    def _wrap(self, value):
+        if not isinstance(value, list):
+            if isinstance(value, basestring):
+                return unicode(value)
+            return value
+
+        return _NodeList(LXMLNode(self, item) if etree.iselement(item)
+                         else unicode(item) for item in value)
+
+    def _evaluate(self, expr, context):
+        if isinstance(expr, XPathQuery):
+            expr = expr.source
+        return self._wrap(compile_xpath(expr)(self._context(context)))
+
+    def evaluate(self, expr, context, resolver, type, result):
+        return XPathResult(self._evaluate(expr, context or None), type)
+
+    def getItemList(self, expr, context=None):
+        return self._evaluate(expr, context).list()
+
+    def getFirstItem(self, expr, context=None):
+        return self._evaluate(expr, context).first()
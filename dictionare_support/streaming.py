@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+
+"""
+Single-pass extraction of text from fixed table layouts.
+
+`StreamQuery` matches a simple path against a page while it is being
+tokenized, collecting only the text below the elements it matches, so no
+document tree is built. The tokenizer is the same `sgmllib` one
+BeautifulSoup uses, and `StreamParser` replays BeautifulSoup's nesting rules
+and `BSXPathEvaluator`'s table fixing (implied `tbody`/`tr`, stray table
+content moved before the table) on the fly, so a query sees the same tree
+the equivalent XPath expression would.
+"""
+
+import re
+
+from htmlentitydefs import name2codepoint
+from operator import attrgetter, itemgetter
+from sgmllib import SGMLParser, SGMLParseError
+
+from BeautifulSoup import BeautifulSoup
+from BSXPath import BSXPathEvaluator
+
+
+STEP_RE = re.compile(r'^([\w-]+)(?:\[(?:(\d+)|count\(([\w-]+)\)>(\d+))\])?$')
+
+# Stands for a `//` in a compiled path.
+GAP = None
+
+
+class UnsupportedMarkup(ValueError):
+    """
+    Raised for markup whose fixed tree `StreamParser` can't follow in a
+    single pass; parse it into a document instead.
+    """
+
+
+def compile_path(path):
+    """
+    Compile `path` into a list of `(name, position, condition)` steps, with
+    `GAP` wherever a `//` separates two steps. `condition` is a
+    `(child name, minimum)` pair for `name[count(child)>minimum]` steps.
+    """
+
+    steps = []
+    for part in path.split('/'):
+        if not part:
+            if not steps or steps[-1] is GAP:
+                raise ValueError('Unsupported path: %s' % path)
+            steps.append(GAP)
+            continue
+
+        match = STEP_RE.match(part)
+        if match is None:
+            raise ValueError('Unsupported step %r in path: %s' % (part, path))
+
+        name, position, count_name, count_minimum = match.groups()
+        steps.append((name,
+                      int(position) if position else None,
+                      (count_name, int(count_minimum)) if count_name else None))
+
+    if steps[-1] is GAP:
+        raise ValueError('Unsupported path: %s' % path)
+    return steps
+
+
+class StreamQuery(object):
+    """
+    A path of child steps, separated by `/` or `//`. Steps may be `name`,
+    `name[n]` or `name[count(child)>n]`.
+
+    `children` are queries looked for below each match of this one. With
+    `texts`, the text nodes below each match are collected as well.
+    """
+
+    def __init__(self, path, texts=False, children=()):
+        self.path = path
+        self.steps = compile_path(path)
+        self.texts = texts
+        self.children = tuple(children)
+
+    def all(self, markup, convertEntities=None):
+        """
+        Return the `StreamMatch`es of this query in `markup` (unicode), in
+        document order. `convertEntities` is as for `BeautifulSoup`.
+        """
+
+        return StreamParser([self], convertEntities).run(markup).all(self)
+
+    def first(self, markup, convertEntities=None):
+        """
+        Return the first `StreamMatch` of this query in `markup`, or `None`.
+        """
+
+        return StreamParser([self], convertEntities).run(markup).first(self)
+
+    def __repr__(self):
+        return 'StreamQuery(%r)' % self.path
+
+
+class StreamMatch(object):
+    """
+    An element matched by a `StreamQuery`. `texts` lists the text nodes
+    below it (like `findAll(text=True)`) if the query collects them.
+    """
+
+    def __init__(self, query, key):
+        self.query = query
+        self.key = key
+        self.texts = None
+
+        self._items = []
+        self._children = {}
+        self._accepted = set()
+
+    @property
+    def text(self):
+        return u''.join(text.strip() for text in self.texts)
+
+    def all(self, query):
+        """
+        Return the matches of the child query `query` below this match, in
+        document order.
+        """
+
+        return sorted(self._children.get(query, ()), key=attrgetter('key'))
+
+    def first(self, query):
+        matches = self._children.get(query)
+        if not matches:
+            return None
+        return min(matches, key=attrgetter('key'))
+
+
+class _Frame(object):
+    """
+    An element of the (fixed) tree, as far as the parser needs to know it.
+
+    `key` orders frames and text nodes in document order. A node's key is
+    its parent's with `(index, 1)` appended; content moved out of a table
+    takes the table's key with the trailing 1 replaced by `(0, n, 1)`, so
+    it sorts just before the table.
+    """
+
+    __slots__ = ('name', 'parent', 'key', 'next_index', 'counts', 'states',
+                 'captures', 'matches', 'held', 'tbody', 'tr', 'displaced')
+
+    def __init__(self, name, parent, key):
+        self.name = name
+        self.parent = parent
+        self.key = key
+        self.next_index = 0
+        self.counts = {}
+        self.states = []
+        self.captures = ()
+        self.matches = []
+        self.held = []
+        self.tbody = None
+        self.tr = None
+        self.displaced = 0
+
+    def child_key(self):
+        key = self.key + (self.next_index, 1)
+        self.next_index += 1
+        return key
+
+
+class StreamParser(SGMLParser):
+    """
+    Tokenizes a page once, matching `queries` against it as elements open
+    and collecting their text as it goes by.
+
+    Each element is tracked twice: on `tagStack`, as BeautifulSoup's parser
+    sees it, and through its `_Frame.parent`, as it ends up after
+    `BSXPathEvaluator._fix_table`. Matching uses the latter.
+    """
+
+    ROOT_TAG_NAME = BeautifulSoup.ROOT_TAG_NAME
+    NESTABLE_TAGS = BeautifulSoup.NESTABLE_TAGS
+    RESET_NESTING_TAGS = BeautifulSoup.RESET_NESTING_TAGS
+    SELF_CLOSING_TAGS = BSXPathEvaluator.SELF_CLOSING_TAGS
+    PRESERVE_WHITESPACE_TAGS = BeautifulSoup.PRESERVE_WHITESPACE_TAGS
+    QUOTE_TAGS = BeautifulSoup.QUOTE_TAGS
+    MARKUP_MASSAGE = BeautifulSoup.MARKUP_MASSAGE
+    STRIP_ASCII_SPACES = BeautifulSoup.STRIP_ASCII_SPACES
+    XML_ENTITIES_TO_SPECIAL_CHARS = BeautifulSoup.XML_ENTITIES_TO_SPECIAL_CHARS
+
+    TABLE_SECTIONS = ('thead', 'tbody', 'tfoot')
+    TABLE_CELLS = ('td', 'th')
+
+    def __init__(self, queries, convertEntities=None):
+        self.queries = queries
+
+        # Character and entity references are decoded (or not) as
+        # BeautifulSoup does for the same `convertEntities`.
+        self.convertEntities = convertEntities
+        self.convertHTMLEntities = convertEntities in (
+            BeautifulSoup.HTML_ENTITIES, BeautifulSoup.XHTML_ENTITIES)
+        self.convertXMLEntities = convertEntities in (
+            BeautifulSoup.XML_ENTITIES, BeautifulSoup.XHTML_ENTITIES)
+
+        SGMLParser.__init__(self)
+
+    def reset(self):
+        SGMLParser.reset(self)
+
+        self.root = StreamMatch(None, ())
+        document = _Frame(self.ROOT_TAG_NAME, None, ())
+        document.states = [(query, 0, self.root, ())
+                           for query in self.queries]
+
+        self.tagStack = [document]
+        self.currentData = []
+        self.quoteStack = []
+
+    def run(self, markup):
+        """
+        Parse `markup` and return the root `StreamMatch`, holding the
+        matches of each of `queries`.
+        """
+
+        for fix, m in self.MARKUP_MASSAGE:
+            markup = fix.sub(m, markup)
+
+        self.reset()
+        self.feed(markup)
+
+        # Close out any unfinished strings and close all the open tags.
+        self.endData()
+        while len(self.tagStack) > 1:
+            self.popTag()
+
+        return self.root
+
+    # Tree building, after BeautifulSoup.
+
+    def popTag(self):
+        self._close(self.tagStack.pop())
+
+    def endData(self):
+        if not self.currentData:
+            return
+
+        data = u''.join(self.currentData)
+        self.currentData = []
+
+        if (data.translate(self.STRIP_ASCII_SPACES) == '' and
+            not any(frame.name in self.PRESERVE_WHITESPACE_TAGS
+                    for frame in self.tagStack)):
+            data = '\n' if '\n' in data else ' '
+
+        self._add_text(data)
+
+    def _popToTag(self, name, inclusivePop=True):
+        if name == self.ROOT_TAG_NAME:
+            return
+
+        numPops = 0
+        for i in range(len(self.tagStack) - 1, 0, -1):
+            if name == self.tagStack[i].name:
+                numPops = len(self.tagStack) - i
+                break
+        if not inclusivePop:
+            numPops = numPops - 1
+
+        for i in range(0, numPops):
+            self.popTag()
+
+    def _smartPop(self, name):
+        nestingResetTriggers = self.NESTABLE_TAGS.get(name)
+        isNestable = nestingResetTriggers is not None
+        isResetNesting = name in self.RESET_NESTING_TAGS
+        popTo = None
+        inclusive = True
+        for i in range(len(self.tagStack) - 1, 0, -1):
+            p = self.tagStack[i]
+            if p.name == name and not isNestable:
+                popTo = name
+                break
+            if (nestingResetTriggers is not None
+                and p.name in nestingResetTriggers) \
+                or (nestingResetTriggers is None and isResetNesting
+                    and p.name in self.RESET_NESTING_TAGS):
+                popTo = p.name
+                inclusive = False
+                break
+        if popTo:
+            self._popToTag(popTo, inclusive)
+
+    def _toStringSubclass(self, text):
+        self.endData()
+        self.handle_data(text)
+        self.endData()
+
+    # SGMLParser handlers.
+
+    def unknown_starttag(self, name, attrs):
+        if self.quoteStack:
+            # This is not a real tag.
+            attrs = ''.join([' %s="%s"' % (x, y) for x, y in attrs])
+            self.handle_data('<%s%s>' % (name, attrs))
+            return
+        self.endData()
+
+        selfClosing = name in self.SELF_CLOSING_TAGS
+        if not selfClosing:
+            self._smartPop(name)
+
+        self.tagStack.append(self._open(name, self.tagStack[-1]))
+        if selfClosing:
+            self.popTag()
+        if name in self.QUOTE_TAGS:
+            self.quoteStack.append(name)
+            self.literal = 1
+
+    def unknown_endtag(self, name):
+        if self.quoteStack and self.quoteStack[-1] != name:
+            # This is not a real end tag.
+            self.handle_data('</%s>' % name)
+            return
+        self.endData()
+        self._popToTag(name)
+        if self.quoteStack and self.quoteStack[-1] == name:
+            self.quoteStack.pop()
+            self.literal = (len(self.quoteStack) > 0)
+
+    def handle_data(self, data):
+        self.currentData.append(data)
+
+    def handle_charref(self, ref):
+        if self.convertEntities:
+            data = unichr(int(ref))
+        else:
+            data = '&#%s;' % ref
+        self.handle_data(data)
+
+    def handle_entityref(self, ref):
+        data = None
+        if self.convertHTMLEntities and ref in name2codepoint:
+            data = unichr(name2codepoint[ref])
+        if not data and self.convertXMLEntities:
+            data = self.XML_ENTITIES_TO_SPECIAL_CHARS.get(ref)
+        if (not data and self.convertHTMLEntities
+                and not self.XML_ENTITIES_TO_SPECIAL_CHARS.get(ref)):
+            # Not an entity BeautifulSoup knows, so it takes the ampersand
+            # for a stray one and escapes it (dropping the semicolon).
+            data = '&amp;%s' % ref
+        if not data:
+            data = '&%s;' % ref
+        self.handle_data(data)
+
+    def handle_comment(self, text):
+        self._toStringSubclass(text)
+
+    def handle_decl(self, data):
+        self._toStringSubclass(data)
+
+    def handle_pi(self, text):
+        if text[:3] == "xml":
+            text = u"xml version='1.0' encoding='%SOUP-ENCODING%'"
+        self._toStringSubclass(text)
+
+    def parse_declaration(self, i):
+        j = None
+        if self.rawdata[i:i+9] == '<![CDATA[':
+            k = self.rawdata.find(']]>', i)
+            if k == -1:
+                k = len(self.rawdata)
+            j = k + 3
+            self._toStringSubclass(self.rawdata[i+9:k])
+        else:
+            try:
+                j = SGMLParser.parse_declaration(self, i)
+            except SGMLParseError:
+                toHandle = self.rawdata[i:]
+                self.handle_data(toHandle)
+                j = i + len(toHandle)
+        return j
+
+    # Table fixing and matching.
+
+    def _open(self, name, parent):
+        """
+        Return the frame for a `name` element opening inside `parent`,
+        placed where `_fix_table` would put it.
+        """
+
+        if parent.name == 'table':
+            table = parent
+            if name in self.TABLE_SECTIONS:
+                self._close_implied(table)
+            elif name == 'tr':
+                self._close_implied(table, 'tr')
+                parent = self._implied(table, 'tbody')
+            elif name in self.TABLE_CELLS:
+                self._implied(table, 'tbody')
+                parent = self._implied(table, 'tr')
+            elif name == 'table':
+                # Moving it in front of its parent would change the
+                # parent's position after it had already been matched.
+                raise UnsupportedMarkup('Table directly inside a table')
+            else:
+                return self._match(_Frame(name, table.parent,
+                                          self._displaced_key(table)))
+
+        return self._match(_Frame(name, parent, parent.child_key()))
+
+    def _implied(self, table, name):
+        """
+        Return the `tbody` or `tr` that `_fix_table` wraps the table's
+        current rows or cells in, creating it if need be.
+        """
+
+        frame = getattr(table, name)
+        if frame is None:
+            parent = table if name == 'tbody' else table.tbody
+            frame = self._match(_Frame(name, parent, parent.child_key()))
+            setattr(table, name, frame)
+        return frame
+
+    def _close_implied(self, table, *names):
+        for name in names or ('tr', 'tbody'):
+            frame = getattr(table, name)
+            if frame is not None:
+                self._close(frame)
+                setattr(table, name, None)
+
+    def _displaced_key(self, table):
+        """
+        Key for table content that `_fix_table` moves out of `table`, in
+        front of it and after anything moved there before.
+        """
+
+        key = table.key[:-1] + (0, table.displaced, 1)
+        table.displaced += 1
+        return key
+
+    def _add_text(self, data):
+        parent = self.tagStack[-1]
+        if parent.name == 'table':
+            key = self._displaced_key(parent)
+            parent = parent.parent
+        else:
+            key = parent.child_key()
+
+        for match in parent.captures:
+            match._items.append((key, data))
+
+    def _match(self, frame):
+        """
+        Advance the parent's partial matches over `frame`, recording the
+        queries it completes.
+        """
+
+        parent = frame.parent
+        position = parent.counts[frame.name] = parent.counts.get(frame.name,
+                                                                 0) + 1
+        frame.captures = parent.captures
+
+        # A `//` can reach the same element along several paths; like
+        # XPath, only count it once.
+        seen = set()
+        states = []
+        for state in parent.states:
+            (query, index, owner, gates) = state
+            steps = query.steps
+            if steps[index] is GAP:
+                if state not in seen:
+                    seen.add(state)
+                    states.append(state)
+                index += 1
+
+            name, step_position, condition = steps[index]
+            if name != frame.name or step_position not in (None, position):
+                continue
+            if condition is not None:
+                # Can only be decided once all of its children are known.
+                gates += ((frame, condition),)
+
+            index += 1
+            state = (query, index, owner, gates)
+            if state in seen:
+                continue
+            seen.add(state)
+
+            if index < len(steps):
+                states.append(state)
+                continue
+
+            match = StreamMatch(query, frame.key)
+            self._accept(match, owner, gates)
+            if query.texts:
+                frame.captures += (match,)
+                frame.matches.append(match)
+            states.extend((child, 0, match, ()) for child in query.children)
+
+        frame.states = states
+        return frame
+
+    def _accept(self, match, owner, gates):
+        if gates:
+            (frame, condition) = gates[-1]
+            frame.held.append((match, owner, gates[:-1], condition))
+        elif (match.query, match.key) not in owner._accepted:
+            owner._accepted.add((match.query, match.key))
+            owner._children.setdefault(match.query, []).append(match)
+
+    def _close(self, frame):
+        if frame.name == 'table':
+            self._close_implied(frame)
+
+        for match in frame.matches:
+            match.texts = [text for _, text in sorted(match._items,
+                                                      key=itemgetter(0))]
+            match._items = []
+
+        for match, owner, gates, (name, minimum) in frame.held:
+            if frame.counts.get(name, 0) > minimum:
+                self._accept(match, owner, gates)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Checks the extraction backends against each other on saved Dictionare
+pages (tests/fixtures). Run from the top of the tree with
+`python -m unittest discover tests`.
+"""
+
+import io
+import os
+import unittest
+
+from dictionare_support.BSXPath import BSXPathEvaluator
+from dictionare_support.connection import read_between
+from dictionare_support.lookup import (CONVERT_ENTITIES, END_TEXT_MARKER,
+                                       START_TEXT_MARKER,
+                                       NOUN_CONTAINERS_STREAM,
+                                       dictionary_markup, extract_nouns,
+                                       extract_verbs, flatten, stream_nouns,
+                                       stream_verbs)
+from dictionare_support.lxmlxpath import LXMLXPathEvaluator, lxml_available
+from dictionare_support.streaming import UnsupportedMarkup
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures')
+
+
+def fixture_markup(name):
+    """
+    The markup `download_markup` would produce for the saved page `name`.
+    """
+
+    with io.open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        text = read_between(f, START_TEXT_MARKER, END_TEXT_MARKER)
+    return dictionary_markup(text)
+
+
+class BackendAgreementTest(unittest.TestCase):
+    """
+    The 'stream' backend, and the 'xpath' one on lxml when it's installed,
+    must give exactly what the 'xpath' one does on BSXPath, down to how
+    entities are decoded.
+    """
+
+    def assertBackendsAgree(self, name, extract, stream):
+        markup = fixture_markup(name)
+        expected = [flatten(i) for i in
+                    extract(BSXPathEvaluator(markup,
+                                             convertEntities=CONVERT_ENTITIES))]
+
+        self.assertEqual(expected, [flatten(i) for i in stream(markup)])
+        if lxml_available:
+            self.assertEqual(expected, [flatten(i) for i in
+                                        extract(LXMLXPathEvaluator(markup))])
+        return expected
+
+    def test_noun(self):
+        (info,) = self.assertBackendsAgree('noun_casa.html', extract_nouns,
+                                           stream_nouns)
+        self.assertEqual(info['headword.plural'], u'case')
+        self.assertEqual(info['declensions.definite.plural.genitive'],
+                         u'caselor')
+
+    def test_nouns_with_several_entries(self):
+        infos = self.assertBackendsAgree('noun_cap.html', extract_nouns,
+                                         stream_nouns)
+        self.assertEqual([i['headword.plural'] for i in infos],
+                         [u'capete', u'capi'])
+
+    def test_noun_falling_back_to_xpath(self):
+        markup = fixture_markup('noun_usa.html')
+        self.assertRaises(UnsupportedMarkup, NOUN_CONTAINERS_STREAM.all,
+                          markup)
+
+        (info,) = self.assertBackendsAgree('noun_usa.html', extract_nouns,
+                                           stream_nouns)
+        self.assertEqual(info['headword.gender'], u'(s.f.)')
+        self.assertEqual(info['declensions.definite.plural.dative'],
+                         u'ușilor')
+
+    def test_verb(self):
+        (info,) = self.assertBackendsAgree('verb_merge.html', extract_verbs,
+                                           stream_verbs)
+        self.assertEqual(info['headword'], u'merge')
+        self.assertEqual(info['conj.ind.prs.2pl'], u'mergeţi')
+        self.assertEqual(info['conj.subj.prs.3sg'], u'să meargă')
+        self.assertEqual(info['conj.cond.perf.1sg'], u'aş fi mers')
+        self.assertEqual(info['gerund'], u'mergând')
+        self.assertEqual(info['conj.imp.2pl'], u'mergeți!')
+
+
+if __name__ == '__main__':
+    unittest.main()